@@ -0,0 +1,67 @@
+"""
+ASGI config for cac_tripplanner project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Served by gunicorn with uvicorn workers, for the async isochrone view only, so that it does not tie
+up a worker while waiting on OTP. The rest of the site is sync, and is served over WSGI.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import asyncio
+import os
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cac_tripplanner.settings")
+
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """Cancel handling of an HTTP request if the client disconnects before it is answered.
+
+    Django (before 5.0) does not listen for the client disconnecting once it has read the request
+    body, so for example an abandoned isochrone request would otherwise still wait on OTP.
+    Here the body is read up front and replayed to Django, while listening for the disconnect.
+    """
+    if scope["type"] != "http":
+        return await django_application(scope, receive, send)
+
+    body_messages = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body_messages.append(message)
+        if not message.get("more_body", False):
+            break
+
+    disconnected = asyncio.get_running_loop().create_future()
+
+    async def replay_receive():
+        if body_messages:
+            return body_messages.pop(0)
+        return await asyncio.shield(disconnected)
+
+    async def listen_for_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set_result(message)
+                return
+
+    request_task = asyncio.ensure_future(django_application(scope, replay_receive, send))
+    disconnect_task = asyncio.ensure_future(listen_for_disconnect())
+    await asyncio.wait([request_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+
+    if request_task.done():
+        disconnect_task.cancel()
+        # raise any error from handling the request
+        request_task.result()
+    else:
+        request_task.cancel()
+        try:
+            await request_task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,51 @@
+import hashlib
+import time
+import uuid
+
+from django.core.cache import caches
+
+# Key in the stamps cache for the stamp that changes whenever site content changes
+CONTENT_VERSION_KEY = 'content_version'
+
+# Which events are current and which articles are published also depends on the time, without
+# anything being saved, so ETags also change after this many seconds
+CONTENT_ETAG_PERIOD = 60 * 5
+
+
+def new_version():
+    return uuid.uuid4().hex
+
+
+def get_content_version():
+    """Returns the current content version stamp.
+
+    Anything derived from published content (in-process indexes, cached documents, ETags) can be
+    keyed on this stamp to know when it is out of date. The stamp is random rather than a counter,
+    so if it is ever lost from the cache, the replacement can't match a stale older value.
+    """
+    return caches['stamps'].get_or_set(CONTENT_VERSION_KEY, new_version, timeout=None)
+
+
+def bump_content_version():
+    """Mark all content derived from the previous content version as out of date."""
+    caches['stamps'].set(CONTENT_VERSION_KEY, new_version(), timeout=None)
+
+
+def get_content_period():
+    """Returns the current CONTENT_ETAG_PERIOD-long period, for keying time-dependent content."""
+    return int(time.time() // CONTENT_ETAG_PERIOD)
+
+
+def content_etag(request, *args, **kwargs):
+    """ETag for a response derived only from site content and the request's query parameters.
+
+    For use as the `etag_func` of Django's `condition` decorator, which answers `If-None-Match`
+    with a 304 before the view runs.
+    """
+    params = sorted(request.GET.lists())
+    stamp = '{path}|{version}|{period}|{params}'.format(
+        path=request.path,
+        version=get_content_version(),
+        period=get_content_period(),
+        params=params)
+    return hashlib.md5(stamp.encode('utf-8')).hexdigest()
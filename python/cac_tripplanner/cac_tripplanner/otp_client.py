@@ -0,0 +1,249 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import random
+import threading
+import time
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Upstream statuses that indicate OTP (or the proxy in front of it) is unhealthy, rather than that
+# the request itself was bad. These count towards opening the circuit breaker.
+FAILURE_STATUSES = (502, 503, 504)
+# Of those, the ones that mean OTP never worked on the request, so it is safe to retry. A 504 (like
+# a read timeout) means OTP already spent its time on the request, and would only do so again.
+RETRY_STATUSES = (502, 503)
+
+
+class OTPUnavailableError(Exception):
+    """Raised when OTP could not be reached, or the circuit breaker is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Fail fast once an upstream service has failed repeatedly.
+
+    After `threshold` consecutive failures the circuit opens and calls are refused for
+    `reset_timeout` seconds. After that, a single trial call is let through; if it succeeds the
+    circuit closes again, otherwise it re-opens for another `reset_timeout`.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half-open: let this request through as a trial, and hold off any others
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error('OTP circuit breaker opened after %d consecutive failures',
+                                 self.failures)
+                self.opened_at = time.monotonic()
+
+
+class OTPClient(object):
+    """Client for making requests to OpenTripPlanner.
+
+    Holds a pool of keep-alive connections, applies connect/read timeouts, retries requests that
+    could not reach OTP with jittered exponential backoff (within an overall deadline), and stops
+    calling OTP while it is unhealthy.
+    Latency and payload size of each call are logged.
+
+    `get` is for use from sync views, and `aget` from async views; they share the circuit breaker.
+
+    Use `get_otp_client` to get the shared client for this process.
+    """
+
+    def __init__(self):
+        self.connect_timeout = settings.OTP_CONNECT_TIMEOUT_S
+        self.read_timeout = settings.OTP_READ_TIMEOUT_S
+        self.deadline = settings.OTP_DEADLINE_S
+        self.max_retries = settings.OTP_MAX_RETRIES
+        self.retry_backoff = settings.OTP_RETRY_BACKOFF_S
+        self.circuit_breaker = CircuitBreaker(settings.OTP_CIRCUIT_BREAKER_THRESHOLD,
+                                              settings.OTP_CIRCUIT_BREAKER_RESET_S)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.OTP_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # httpx clients are bound to the event loop they are first used on; see
+        # `async_client_for_loop`
+        self.async_client = None
+        self.async_client_loop = None
+
+    def backoff(self, attempt):
+        """Seconds to wait before the given retry attempt (starting at 1)."""
+        delay = self.retry_backoff * (2 ** (attempt - 1))
+        return delay + random.uniform(0, delay)
+
+    def attempt_read_timeout(self, deadline_at):
+        """Read timeout for an attempt, so that it ends by the overall deadline.
+
+        :raises OTPUnavailableError: if the deadline leaves no time for another attempt
+        """
+        remaining = deadline_at - time.monotonic() - self.connect_timeout
+        if remaining <= 0:
+            raise OTPUnavailableError('OTP deadline of {deadline}s exceeded'.format(
+                deadline=self.deadline))
+        return min(self.read_timeout, remaining)
+
+    def make_async_client(self):
+        timeout = httpx.Timeout(settings.OTP_READ_TIMEOUT_S,
+                                connect=settings.OTP_CONNECT_TIMEOUT_S)
+        limits = httpx.Limits(max_connections=settings.OTP_ASYNC_POOL_SIZE,
+                              max_keepalive_connections=settings.OTP_POOL_SIZE)
+        return httpx.AsyncClient(timeout=timeout, limits=limits)
+
+    @asynccontextmanager
+    async def async_client_for_loop(self):
+        """Yields an async HTTP client for the running event loop.
+
+        Under the ASGI server, the event loop runs in the main thread for the life of the worker,
+        so its requests share one client and its pool of keep-alive connections.
+        Other loops (i.e. the one `async_to_sync` starts for each request under WSGI) only last
+        for the request, so they get a client of their own, which is closed along with it.
+        """
+        loop = asyncio.get_running_loop()
+        if self.async_client_loop is loop:
+            yield self.async_client
+        elif threading.current_thread() is threading.main_thread():
+            # only replaced if the server's loop is ever restarted, when the old one is gone
+            self.async_client = self.make_async_client()
+            self.async_client_loop = loop
+            yield self.async_client
+        else:
+            async with self.make_async_client() as client:
+                yield client
+
+    def check_response(self, url, response, error, retryable, start, attempt, deadline_at):
+        """Record the outcome of a request to OTP.
+
+        :param error: Description of the network error, or None if there was a response
+        :param retryable: Whether the network error means OTP never received the request
+        :returns: True if the request succeeded, False if it should be retried
+        :raises OTPUnavailableError: if the request failed and should not be retried
+        """
+        elapsed_ms = (time.monotonic() - start) * 1000
+        if error is None and response.status_code in FAILURE_STATUSES:
+            error = 'status {status}'.format(status=response.status_code)
+            retryable = response.status_code in RETRY_STATUSES
+
+        if error is None:
+            logger.info('OTP GET %s: %d in %.0fms, %d bytes', url, response.status_code,
+                        elapsed_ms, len(response.content))
+            self.circuit_breaker.record_success()
+            return True
+
+        logger.warning('OTP GET %s failed in %.0fms (attempt %d): %s', url, elapsed_ms,
+                       attempt, error)
+        self.circuit_breaker.record_failure()
+        if (not retryable or attempt > self.max_retries or
+                time.monotonic() + self.backoff(attempt) >= deadline_at or
+                not self.circuit_breaker.allow_request()):
+            raise OTPUnavailableError(error)
+        return False
+
+    def get(self, url, params=None, headers=None):
+        """Make a GET request to OTP.
+
+        :param url: OTP endpoint URL
+        :param params: Query parameters
+        :param headers: Request headers
+        :returns: `requests.Response` from OTP; only network errors and gateway error statuses
+                  are treated as failures, so other error responses are returned as-is
+        :raises OTPUnavailableError: if OTP could not be reached, or the circuit breaker is open
+        """
+        if not self.circuit_breaker.allow_request():
+            raise OTPUnavailableError('OTP circuit breaker is open')
+
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 1
+        while True:
+            timeout = (self.connect_timeout, self.attempt_read_timeout(deadline_at))
+            start = time.monotonic()
+            response, error, retryable = None, None, False
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=timeout)
+            except requests.RequestException as e:
+                error = str(e)
+                # includes connect timeouts, but not read timeouts
+                retryable = isinstance(e, requests.ConnectionError)
+            if self.check_response(url, response, error, retryable, start, attempt, deadline_at):
+                return response
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def aget(self, url, params=None, headers=None):
+        """Make a GET request to OTP without blocking the event loop.
+
+        Takes the same arguments as `get`, but returns an `httpx.Response`.
+        If the calling task is cancelled (i.e. because the client disconnected), the upstream
+        request is abandoned and its connection closed.
+        """
+        if not self.circuit_breaker.allow_request():
+            raise OTPUnavailableError('OTP circuit breaker is open')
+
+        async with self.async_client_for_loop() as client:
+            deadline_at = time.monotonic() + self.deadline
+            attempt = 1
+            while True:
+                timeout = httpx.Timeout(self.attempt_read_timeout(deadline_at),
+                                        connect=self.connect_timeout)
+                start = time.monotonic()
+                response, error, retryable = None, None, False
+                try:
+                    response = await client.get(url, params=params, headers=headers,
+                                                timeout=timeout)
+                except httpx.HTTPError as e:
+                    error = str(e) or type(e).__name__
+                    retryable = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                except asyncio.CancelledError:
+                    logger.info('OTP GET %s cancelled after %.0fms', url,
+                                (time.monotonic() - start) * 1000)
+                    raise
+                if self.check_response(url, response, error, retryable, start, attempt,
+                                       deadline_at):
+                    return response
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+
+
+_otp_client = None
+
+
+def get_otp_client():
+    """Returns the OTP client for this process, creating it on first use.
+
+    Created lazily so that each gunicorn worker gets its own connection pool.
+    """
+    global _otp_client
+    if _otp_client is None:
+        _otp_client = OTPClient()
+    return _otp_client
@@ -1,5 +1,10 @@
+from django.dispatch import Signal
 from django.utils.translation import gettext_lazy
 
+# Sent with the model class as sender when admin actions publish or unpublish objects in bulk,
+# since `QuerySet.update` does not send `post_save`.
+published_changed = Signal()
+
 
 class PublishableMixin:
     """Helper to add Django admin actions to publish and unpublish model objects."""
@@ -8,10 +13,12 @@ class PublishableMixin:
 
     def make_published(self, request, queryset):
         queryset.update(published=True)
+        published_changed.send(sender=queryset.model)
 
     make_published.short_description = gettext_lazy("Publish selected %(verbose_name_plural)s")
 
     def make_unpublished(self, request, queryset):
         queryset.update(published=False)
+        published_changed.send(sender=queryset.model)
 
     make_unpublished.short_description = gettext_lazy("Unpublish selected %(verbose_name_plural)s")
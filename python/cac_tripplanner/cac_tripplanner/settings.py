@@ -113,6 +113,7 @@ INSTALLED_APPS = (
     "django.contrib.messages",
     "django.contrib.staticfiles",
     "django.contrib.gis",
+    "django.contrib.postgres",
     # Third Party Apps
     "ckeditor",
     "django_extensions",
@@ -145,6 +146,42 @@ WSGI_APPLICATION = "cac_tripplanner.wsgi.application"
 
 DATABASES = {"default": secrets["database"]}
 
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+#
+# The default cache is database-backed so that it is shared by all gunicorn workers
+# (and app servers); create its tables with `python3 manage.py createcachetable`. It only holds
+# a few small entries, such as the shuffled order of listings and locks on requests to OTP.
+# The stamps that invalidate everything derived from content or from the OTP graph are kept in a
+# database-backed cache of their own, so that they are never culled to make room for other entries.
+# Content derived from the database (JSON documents, vector tiles, and rendered cards and listings)
+# and isochrones are held in memory per worker, with least-recently-used eviction; content is
+# keyed on the content version stamp, so it is never used once out of date.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "cac_tripplanner_cache",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    "stamps": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "cac_tripplanner_stamps",
+        "TIMEOUT": None,
+    },
+    "content": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "cac-content",
+        "TIMEOUT": 60 * 60 * 24,
+        "OPTIONS": {"MAX_ENTRIES": 5000},
+    },
+    "isochrones": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "cac-isochrones",
+        "TIMEOUT": 60 * 60 * 6,
+        "OPTIONS": {"MAX_ENTRIES": 500},
+    },
+}
+
 # Image processing configuration
 IMAGE_CROPPING_SIZE_WARNING = True
 
@@ -326,6 +363,36 @@ OTP_URL = secrets["otp_url"]
 ROUTING_URL = OTP_URL.format(router="default") + "plan"
 ISOCHRONE_URL = OTP_URL.format(router="default") + "isochrone"
 
+# Requests to OTP from the app (see `cac_tripplanner.otp_client`)
+# Keep the deadline for a request, including any retries, below otp_session_timeout_s,
+# the gunicorn and nginx timeout (less OTP_CONNECT_TIMEOUT_S, which isochrone requests waiting on
+# another's in-flight request to OTP may wait for beyond the deadline)
+OTP_CONNECT_TIMEOUT_S = 3.05
+OTP_READ_TIMEOUT_S = 60
+OTP_DEADLINE_S = 75
+# Number of keep-alive connections to OTP held by each worker
+OTP_POOL_SIZE = 10
+# Maximum concurrent connections to OTP from each worker's async views
+OTP_ASYNC_POOL_SIZE = 200
+# Retries for connection errors and 502/503 responses, with jittered exponential backoff
+# (read timeouts and 504s are not retried, since OTP has already worked on the request)
+OTP_MAX_RETRIES = 2
+OTP_RETRY_BACKOFF_S = 0.25
+# Stop calling OTP for OTP_CIRCUIT_BREAKER_RESET_S seconds after this many consecutive failures
+OTP_CIRCUIT_BREAKER_THRESHOLD = 5
+OTP_CIRCUIT_BREAKER_RESET_S = 30
+
+# Isochrone requests are snapped to a coordinate grid and departure-time window before being
+# sent to OTP, so that nearby requests share a cached travelshed.
+# Number of decimal places origin coordinates round to (3 is roughly 100m)
+ISOCHRONE_CACHE_ORIGIN_PRECISION = 3
+# Length of the departure-time window, in minutes
+ISOCHRONE_CACHE_TIME_BUCKET_MINUTES = 15
+# Isochrones returned to the client are simplified to this many pixels at the display zoom level,
+# and their coordinates rounded to this many decimal places (5 is roughly 1m)
+ISOCHRONE_SIMPLIFY_PIXELS = 0.5
+ISOCHRONE_COORDINATE_PRECISION = 5
+
 # Settings for S3 storage
 # No need to specify AWS access and secret keys -- they are pulled from
 # the instance metadata by boto.
@@ -345,3 +412,17 @@ MAX_IMAGE_SIZE_MB = 2
 # limit the number of featured destinations/articles returned by "view all" to this amount
 # TODO: paginate instead?
 HOMEPAGE_RESULTS_LIMIT = 20
+
+# page size for destination search results paged with a cursor, if no limit is given,
+# and the largest page size that may be requested
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# most destinations returned by a search for those nearest a point, with or without a limit;
+# enough for the web client to list every destination by distance from the origin
+SEARCH_NEAREST_LIMIT = 500
+# destinations in a map viewport are grouped into clusters at zoom levels below this,
+# by grid cells of this many pixels across
+CLUSTER_MAX_ZOOM = 13
+CLUSTER_CELL_PIXELS = 64
+# seconds browsers may cache map vector tiles for without revalidating them
+TILE_MAX_AGE = 60 * 5
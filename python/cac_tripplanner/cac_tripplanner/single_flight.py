@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class InFlight(object):
+    """A computation in progress, and the number of callers waiting on it."""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Coalesce concurrent identical computations, so only one of them is actually run.
+
+    Within a process, concurrent callers with the same key await the first caller's result.
+    Across processes, the first caller takes a lock in the shared (default) cache; callers in
+    other processes wait, with a backing-off poll, for the lock to be released instead of
+    computing alongside it. Only the lock is kept in the shared cache, never the result, so once
+    the lock is released a waiting caller loads the result from wherever the computation stored it
+    (if it can see it), or else takes the lock and runs the computation itself.
+    """
+
+    def __init__(self, namespace, lock_timeout, poll_interval=0.1, max_poll_interval=1.5):
+        """
+        :param namespace: Prefix for this group's keys in the shared cache
+        :param lock_timeout: Seconds after which a lock is abandoned, if never released
+        :param poll_interval: Seconds before first checking a lock held by another process
+        :param max_poll_interval: Seconds between checks, once the interval has backed off
+        """
+        self.namespace = namespace
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.in_flight = {}
+
+    def lock_key(self, key):
+        return '{namespace}:lock:{key}'.format(namespace=self.namespace, key=key)
+
+    async def do(self, key, compute, load=None):
+        """Run `compute`, unless an identical computation is already in flight.
+
+        The computation runs as its own task, so that one caller being cancelled (i.e. because
+        its client disconnected) does not cancel it for the others. It is only cancelled once
+        every caller waiting on it has been.
+
+        :param key: String identifying the computation
+        :param compute: Async callable taking no arguments, returning the result
+        :param load: Optional async callable taking no arguments, returning the result stored by
+                     a computation that has already finished, or None if there is none
+        :returns: Result of `compute`, from this caller or from another
+        """
+        loop = asyncio.get_running_loop()
+        flight = self.in_flight.get(key)
+        # tasks can only be awaited from their own event loop
+        if flight is None or flight.task.get_loop() is not loop:
+            flight = InFlight(loop.create_task(self.do_shared(key, compute, load)))
+            self.in_flight[key] = flight
+            flight.task.add_done_callback(lambda task: self.landed(key, flight))
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def landed(self, key, flight):
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+    async def do_shared(self, key, compute, load=None):
+        """Run `compute` while holding the shared lock for `key`, or wait for the lock holder."""
+        cache = caches['default']
+        lock_key = self.lock_key(key)
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            if await cache.aadd(lock_key, True, timeout=self.lock_timeout):
+                try:
+                    return await compute()
+                finally:
+                    await cache.adelete(lock_key)
+
+            # another process is computing; wait for it to release the lock
+            interval = self.poll_interval
+            while time.monotonic() < deadline:
+                await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+                interval = min(interval * 2, self.max_poll_interval)
+                if await cache.aget(lock_key) is None:
+                    break
+            else:
+                logger.warning('Timed out waiting on in-flight computation for %s', key)
+                return await compute()
+
+            result = await load() if load is not None else None
+            if result is not None:
+                logger.debug('Used result of in-flight computation for %s', key)
+                return result
+            # released without a result visible here; try to take the lock
@@ -1,11 +1,29 @@
+import asyncio
 from datetime import datetime
 import os
 import json
+import threading
+from unittest import mock
 
+import requests
+
+from django.core.cache import caches
+from django.http import QueryDict
 from django.test import TestCase, Client
 
 from django.contrib.gis.geos import GEOSGeometry
 
+from cac_tripplanner.asgi import application as asgi_application
+from cac_tripplanner.otp_client import CircuitBreaker, OTPClient, OTPUnavailableError
+from cac_tripplanner.single_flight import SingleFlight
+from destinations.isochrones import (encode_polyline,
+                                     flush_isochrone_cache,
+                                     isochrone_bands,
+                                     isochrone_cache_key,
+                                     parse_cutoffs,
+                                     simplify_isochrone,
+                                     snap_isochrone_params,
+                                     ISOCHRONE_GENERATION_KEY)
 from destinations.models import Destination
 
 class CACTripPlannerIsochroneTestCase(TestCase):
@@ -106,3 +124,344 @@ class CACTripPlannerIsochroneTestCase(TestCase):
 
         response = self.client.get(isochrone_url)
         self.assertEqual(400, response.status_code)
+
+    def test_isochrone_zoom_outside_range(self):
+        """Return error if zoom parameter is outside allowed range"""
+
+        isochrone_start = '/map/reachable?fromPlace=39.954688%2C-75.204677&mode%5B%5D=WALK%2DTRANSIT&time=7%3A30am&cutoffSec=2000&maxWalkDistance=5000'
+        for zoom in ('-1', '23', '2000'):
+            isochrone_url = '{start}&zoom={zoom}'.format(start=isochrone_start, zoom=zoom)
+            response = self.client.get(isochrone_url)
+            self.assertEqual(400, response.status_code)
+
+
+class ASGIDisconnectTestCase(TestCase):
+    """ Test that a request is abandoned when its client disconnects """
+
+    async def test_disconnect_cancels_otp_request(self):
+        otp_started = asyncio.Event()
+        otp_cancelled = asyncio.Event()
+
+        async def hang(*args, **kwargs):
+            otp_started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                otp_cancelled.set()
+                raise
+
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # the client gives up while the view is waiting on OTP
+            await otp_started.wait()
+            return {'type': 'http.disconnect'}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        query = ('fromPlace=39.954688%2C-75.204677&mode%5B%5D=WALK%2DTRANSIT&time=7%3A30am'
+                 '&cutoffSec=2000&maxWalkDistance=5000&date={day}').format(
+            day=datetime.now().date())
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': '/map/reachable',
+            'raw_path': b'/map/reachable',
+            'query_string': query.encode('utf-8'),
+            'root_path': '',
+            'headers': [(b'host', b'testserver')],
+            'client': ('127.0.0.1', 50000),
+            'server': ('testserver', 80),
+        }
+        with mock.patch.object(OTPClient, 'aget', hang):
+            await asyncio.wait_for(asgi_application(scope, receive, send), timeout=10)
+
+        self.assertTrue(otp_started.is_set())
+        self.assertTrue(otp_cancelled.is_set())
+        # nothing is sent to a client that has gone
+        self.assertEqual(sent, [])
+
+
+class IsochroneCacheKeyTestCase(TestCase):
+    """ Test snapping of isochrone requests to the cache grid """
+
+    def get_key(self, query_string):
+        return isochrone_cache_key(snap_isochrone_params(QueryDict(query_string)))
+
+    def test_snap_params(self):
+        params = snap_isochrone_params(QueryDict('fromPlace=39.954688%2C-75.204677&time=7%3A37am'))
+        self.assertEqual(params['fromPlace'], '39.955,-75.205')
+        self.assertEqual(params['time'], '07:30am')
+
+    def test_nearby_requests_share_key(self):
+        key = self.get_key('fromPlace=39.954688%2C-75.204677&time=07%3A31am&cutoffSec=1800')
+        self.assertEqual(key, self.get_key('cutoffSec=1800&time=07%3A44am&'
+                                           'fromPlace=39.95491%2C-75.20512'))
+        # categories only filter destinations, so do not change the isochrone
+        self.assertEqual(key, self.get_key('fromPlace=39.954688%2C-75.204677&time=07%3A31am&'
+                                           'cutoffSec=1800&categories=Nature'))
+
+    def test_different_requests_have_different_keys(self):
+        key = self.get_key('fromPlace=39.954688%2C-75.204677&time=07%3A31am&cutoffSec=1800')
+        self.assertNotEqual(key, self.get_key('fromPlace=39.954688%2C-75.204677&time=07%3A46am&'
+                                              'cutoffSec=1800'))
+        self.assertNotEqual(key, self.get_key('fromPlace=39.954688%2C-75.204677&time=07%3A31am&'
+                                              'cutoffSec=2700'))
+        self.assertNotEqual(key, self.get_key('fromPlace=39.96%2C-75.204677&time=07%3A31am&'
+                                              'cutoffSec=1800'))
+
+    def test_flush_changes_key(self):
+        query_string = 'fromPlace=39.954688%2C-75.204677&time=07%3A31am&cutoffSec=1800'
+        key = self.get_key(query_string)
+        flush_isochrone_cache()
+        self.assertNotEqual(key, self.get_key(query_string))
+
+    def test_lost_generation_changes_key(self):
+        """Isochrones cached before the generation was evicted should not be used again"""
+        query_string = 'fromPlace=39.954688%2C-75.204677&time=07%3A31am&cutoffSec=1800'
+        key = self.get_key(query_string)
+        caches['stamps'].delete(ISOCHRONE_GENERATION_KEY)
+        self.assertNotEqual(key, self.get_key(query_string))
+
+
+class OTPCircuitBreakerTestCase(TestCase):
+    """ Test that the OTP client stops calling OTP after repeated failures """
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+        for _ in range(2):
+            breaker.record_failure()
+            self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+
+    def test_half_open_after_reset_timeout(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        # one trial request is allowed once the reset timeout has passed
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertTrue(breaker.allow_request())
+
+
+class OTPClientRetryTestCase(TestCase):
+    """ Test that only requests that never reached OTP are retried """
+
+    def setUp(self):
+        self.client = OTPClient()
+        self.client.retry_backoff = 0
+
+    def test_connection_error_retried(self):
+        with mock.patch.object(self.client.session, 'get',
+                               side_effect=requests.ConnectionError('refused')) as get:
+            with self.assertRaises(OTPUnavailableError):
+                self.client.get('http://otp/isochrone')
+        self.assertEqual(get.call_count, self.client.max_retries + 1)
+
+    def test_read_timeout_not_retried(self):
+        with mock.patch.object(self.client.session, 'get',
+                               side_effect=requests.ReadTimeout('timed out')) as get:
+            with self.assertRaises(OTPUnavailableError):
+                self.client.get('http://otp/isochrone')
+        self.assertEqual(get.call_count, 1)
+
+    def test_gateway_timeout_not_retried(self):
+        response = mock.Mock(status_code=504, content=b'')
+        with mock.patch.object(self.client.session, 'get', return_value=response) as get:
+            with self.assertRaises(OTPUnavailableError):
+                self.client.get('http://otp/isochrone')
+        self.assertEqual(get.call_count, 1)
+
+
+class OTPAsyncClientTestCase(TestCase):
+    """ Test that async clients don't outlive the event loops they are used on """
+
+    async def use_client(self, otp_client):
+        async with otp_client.async_client_for_loop() as client:
+            return client
+
+    def test_per_request_loop_client_closed(self):
+        otp_client = OTPClient()
+        clients = []
+        # as under WSGI, where async_to_sync runs each request's loop in another thread
+        for _ in range(2):
+            thread = threading.Thread(
+                target=lambda: clients.append(asyncio.run(self.use_client(otp_client))))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(clients), 2)
+        self.assertTrue(all(client.is_closed for client in clients))
+        self.assertIsNone(otp_client.async_client)
+
+    def test_server_loop_client_shared(self):
+        otp_client = OTPClient()
+
+        async def serve():
+            # as under the ASGI server, where the loop runs in the main thread
+            first, second = await self.use_client(otp_client), await self.use_client(otp_client)
+            closed = first.is_closed
+            await first.aclose()
+            return first, second, closed
+
+        first, second, closed = asyncio.run(serve())
+        self.assertIs(first, second)
+        self.assertFalse(closed)
+
+
+class IsochroneSimplificationTestCase(TestCase):
+    """ Test post-processing of isochrones returned to the client """
+
+    def setUp(self):
+        # square with an extra, nearly collinear vertex along its bottom edge
+        self.json_poly = {
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature',
+                'properties': {'time': 1800},
+                'geometry': {
+                    'type': 'MultiPolygon',
+                    'coordinates': [[[[-75.1, 39.9], [-75.0500000001, 39.9000001], [-75.0, 39.9],
+                                      [-75.0, 40.0], [-75.1, 40.0], [-75.1, 39.9]]]]
+                }
+            }]
+        }
+
+    def test_simplify(self):
+        simplified = simplify_isochrone(self.json_poly, 0.001)
+        feature = simplified['features'][0]
+        self.assertEqual(feature['properties'], {'time': 1800})
+        ring = feature['geometry']['coordinates'][0][0]
+        self.assertEqual(len(ring), 5)
+        self.assertIn([-75.1, 39.9], ring)
+
+    def test_polyline_encoding(self):
+        # example from https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+        self.assertEqual(encode_polyline([[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]], 5),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+        simplified = simplify_isochrone(self.json_poly, 0.001, 'polyline')
+        geometry = simplified['features'][0]['geometry']
+        self.assertEqual(geometry['encoding'], 'polyline')
+        self.assertIsInstance(geometry['coordinates'][0][0], str)
+
+    def test_empty_isochrone(self):
+        self.assertEqual(simplify_isochrone({}, 0.001), {})
+
+
+class IsochroneBandsTestCase(TestCase):
+    """ Test splitting multi-cutoff isochrones into travel time bands """
+
+    def feature(self, time, size):
+        return {
+            'type': 'Feature',
+            'properties': {'time': time},
+            'geometry': {
+                'type': 'MultiPolygon',
+                'coordinates': [[[[0, 0], [0, size], [size, size], [size, 0], [0, 0]]]]
+            }
+        }
+
+    def test_parse_cutoffs(self):
+        self.assertEqual(parse_cutoffs(QueryDict('cutoffSec=1800&cutoffSec=900')), [900, 1800])
+        self.assertEqual(parse_cutoffs(QueryDict('cutoffSec=900,2700,900')), [900, 2700])
+        self.assertEqual(parse_cutoffs(QueryDict('')), [])
+        with self.assertRaises(ValueError):
+            parse_cutoffs(QueryDict('cutoffSec=soon'))
+
+    def test_bands(self):
+        json_poly = {'type': 'FeatureCollection',
+                     'features': [self.feature(1800, 2), self.feature(900, 1)]}
+        bands = isochrone_bands(json_poly, [900, 1800])
+        self.assertEqual([cutoff for cutoff, _ in bands], [900, 1800])
+        self.assertEqual(bands[0][1].area, 1)
+        self.assertEqual(bands[1][1].area, 4)
+
+    def test_empty_isochrone(self):
+        self.assertEqual(isochrone_bands({}, [900]), [])
+
+
+class SingleFlightTestCase(TestCase):
+    """ Test coalescing of identical concurrent computations """
+
+    async def test_concurrent_calls_share_result(self):
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {'calls': len(calls)}
+
+        flights = SingleFlight('test_flight', lock_timeout=5)
+        results = await asyncio.gather(*[flights.do('same', compute) for _ in range(5)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'calls': 1}] * 5)
+
+    async def test_failure_is_not_shared_later(self):
+        flights = SingleFlight('test_flight_failure', lock_timeout=5)
+
+        async def fail():
+            raise ValueError('OTP down')
+
+        async def succeed():
+            return 'ok'
+
+        with self.assertRaises(ValueError):
+            await flights.do('key', fail)
+        self.assertEqual(await flights.do('key', succeed), 'ok')
+
+    async def test_waits_for_lock_held_elsewhere(self):
+        """A lock held by another process is waited on, then the stored result is loaded"""
+        flights = SingleFlight('test_flight_shared', lock_timeout=5, poll_interval=0.01)
+        stored = {}
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            return 'computed'
+
+        async def load():
+            return stored.get('key')
+
+        async def other_process():
+            await asyncio.sleep(0.05)
+            stored['key'] = 'stored'
+            await caches['default'].adelete(flights.lock_key('key'))
+
+        await caches['default'].aadd(flights.lock_key('key'), True, timeout=5)
+        result, _ = await asyncio.gather(flights.do('key', compute, load=load), other_process())
+        self.assertEqual(result, 'stored')
+        self.assertEqual(calls, [])
+        self.assertIsNone(await caches['default'].aget(flights.lock_key('key')))
+
+    async def test_computes_when_result_not_visible(self):
+        """Once another process releases the lock, a result that can't be loaded is computed"""
+        flights = SingleFlight('test_flight_unseen', lock_timeout=5, poll_interval=0.01)
+
+        async def compute():
+            return 'computed'
+
+        async def load():
+            return None
+
+        async def other_process():
+            await asyncio.sleep(0.05)
+            await caches['default'].adelete(flights.lock_key('key'))
+
+        await caches['default'].aadd(flights.lock_key('key'), True, timeout=5)
+        result, _ = await asyncio.gather(flights.do('key', compute, load=load), other_process())
+        self.assertEqual(result, 'computed')
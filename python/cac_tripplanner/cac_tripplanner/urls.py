@@ -27,6 +27,21 @@ urlpatterns = [
         dest_views.SearchDestinations.as_view(),
         name="api_destinations_search",
     ),
+    re_path(
+        r"^api/destinations/autocomplete$",
+        dest_views.AutocompleteDestinations.as_view(),
+        name="api_destinations_autocomplete",
+    ),
+    re_path(
+        r"^api/destinations/viewport$",
+        dest_views.ViewportDestinations.as_view(),
+        name="api_destinations_viewport",
+    ),
+    re_path(
+        r"^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.mvt$",
+        dest_views.destination_tile,
+        name="destination_tile",
+    ),
     re_path(r"^map/reachable$", dest_views.FindReachableDestinations.as_view(), name="reachable"),
     # Handle pre-redesign URLs by redirecting
     re_path(
@@ -5,6 +5,8 @@ from django.utils.timezone import now
 
 from image_cropping import ImageCroppingMixin
 
+from cac_tripplanner.publish_utils import published_changed
+
 from .forms import AboutFaqForm, ArticleForm
 from .models import AboutFaq, Article
 
@@ -47,9 +49,11 @@ class ArticleAdmin(ImageCroppingMixin, admin.ModelAdmin):
 
     def make_published(self, request, queryset):
         queryset.update(publish_date=now())
+        published_changed.send(sender=queryset.model)
     make_published.short_description = 'Publish selected articles'
 
     def make_unpublished(self, request, queryset):
         # unpublish articles by setting their publication date far in the future
         queryset.update(publish_date=now() + timedelta(days=200 * 365))
+        published_changed.send(sender=queryset.model)
     make_unpublished.short_description = 'Unpublish selected articles'
@@ -6,3 +6,7 @@ class CMSConfig(AppConfig):
     name = 'cms'
     label = 'CMS'
     verbose_name = 'Content Management System'
+
+    def ready(self):
+        from .signals import connect_signals
+        connect_signals()
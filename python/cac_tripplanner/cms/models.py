@@ -1,11 +1,15 @@
+import random
+
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.db import models
 from django.utils.timezone import now
 
 from ckeditor.fields import RichTextField
 from image_cropping import ImageCropField, ImageRatioField
 
+from cac_tripplanner.content_version import get_content_version
 from cac_tripplanner.image_utils import generate_image_filename
 
 ARTICLE_NARROW_IMAGE_DIMENSIONS = (310, 218)
@@ -13,6 +17,10 @@ ARTICLE_WIDE_IMAGE_DIMENSIONS = (680, 200)
 ARTICLE_NARROW_IMAGE_DIMENSION_STRING = 'x'.join([str(x) for x in ARTICLE_NARROW_IMAGE_DIMENSIONS])
 ARTICLE_WIDE_IMAGE_DIMENSION_STRING = 'x'.join([str(x) for x in ARTICLE_WIDE_IMAGE_DIMENSIONS])
 
+# Lists of article publish dates are keyed on the content version, so are replaced as soon as
+# any article changes; the timeout only limits how long those for past versions are kept
+PUBLISH_DATES_TIMEOUT = 60 * 60 * 24
+
 
 def generate_filename(instance, filename):
     """Helper for generating image filenames"""
@@ -30,11 +38,28 @@ class ArticleManager(models.Manager):
     def published(self):
         return self.get_queryset().filter(publish_date__lt=now())
 
+    def publish_dates(self):
+        """Returns a list of the IDs and publish dates of all articles, from the content cache."""
+        key = 'article_publish_dates:{manager}:{version}'.format(manager=type(self).__name__,
+                                                                 version=get_content_version())
+        return caches['content'].get_or_set(
+            key, lambda: list(self.get_queryset().values_list('pk', 'publish_date')),
+            timeout=PUBLISH_DATES_TIMEOUT)
+
     def random(self):
-        """Returns a randomized article"""
+        """Returns a randomized article
+
+        The article is chosen from the cached list of publish dates, rather than by having the
+        database sort every published article randomly.
+        """
+        current_time = now()
+        published_ids = [pk for pk, publish_date in self.publish_dates()
+                         if publish_date and publish_date < current_time]
+        if not published_ids:
+            return None
         # Need to use the full object, because there is a magic transformation of the URL
         # at some point which is needed for assembling the s3 url.
-        return self.published().order_by('?').first()
+        return self.get_queryset().filter(pk=random.choice(published_ids)).first()
 
 
 class CommunityProfileManager(ArticleManager):
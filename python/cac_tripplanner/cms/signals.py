@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+
+from cac_tripplanner.content_version import bump_content_version
+from cac_tripplanner.publish_utils import published_changed
+
+from .models import Article
+
+
+def article_changed(sender, **kwargs):
+    """Mark content derived from articles out of date when articles are changed."""
+    if kwargs.get('raw'):
+        # loading fixtures
+        return
+    bump_content_version()
+
+
+def connect_signals():
+    post_save.connect(article_changed, sender=Article)
+    post_delete.connect(article_changed, sender=Article)
+    published_changed.connect(article_changed, sender=Article)
@@ -112,3 +112,20 @@ class ArticleTests(TestCase):
 
         self.assertContains(response, self.published_comm.title, status_code=200)
         self.assertContains(response, self.published_tips.title, status_code=200)
+
+    def test_articles_api_conditional_get(self):
+        """Articles API should answer 304 until an article changes"""
+        url = reverse("api_articles")
+        response = self.client.get(url)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # different parameters get a different ETag
+        response = self.client.get(url + "?limit=1", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        self.published_comm.title = "updated-comm"
+        self.published_comm.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, "updated-comm", status_code=200)
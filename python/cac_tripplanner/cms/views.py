@@ -4,8 +4,12 @@ from django.conf import settings
 from django.urls import reverse
 from django.http import HttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.views.generic import View
 
+from cac_tripplanner.content_version import content_etag
+
 from .models import AboutFaq, Article
 
 
@@ -46,6 +50,7 @@ class AllArticles(View):
             'url': request.build_absolute_uri(reverse(learn_detail, args=[article.slug]))
         }
 
+    @method_decorator(condition(etag_func=content_etag))
     def get(self, request, *args, **kwargs):
         """GET title, URL, and images for published articles."""
         try:
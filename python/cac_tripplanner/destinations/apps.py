@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DestinationsConfig(AppConfig):
     name = 'destinations'
     verbose_name = 'Destinations, Events, and Tours'
+
+    def ready(self):
+        from .signals import connect_signals
+        connect_signals()
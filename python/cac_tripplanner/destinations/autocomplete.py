@@ -0,0 +1,150 @@
+from bisect import bisect_left
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from django.db.models import Prefetch
+from django.utils.timezone import now
+
+from cac_tripplanner.content_version import get_content_version
+
+from .models import Destination, Event, EventDestination, Tour, TourDestination
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the content version, so most requests need not read it
+VERSION_CHECK_INTERVAL = 5
+
+NON_ALPHANUMERIC = re.compile(r'[^0-9a-z]+')
+
+
+def normalize(text):
+    """Normalize text for matching: lowercase, unaccented, with punctuation collapsed to spaces."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return NON_ALPHANUMERIC.sub(' ', text.lower()).strip()
+
+
+class Suggestion(object):
+    """A destination, event, or tour that can be suggested."""
+
+    __slots__ = ('id', 'type', 'name', 'priority', 'x', 'y', 'end_date')
+
+    def __init__(self, id, type, name, priority, point, end_date=None):
+        self.id = id
+        self.type = type
+        self.name = name
+        self.priority = priority
+        self.x = point.x if point else None
+        self.y = point.y if point else None
+        self.end_date = end_date
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'name': self.name,
+            'point': ({'type': 'Point', 'coordinates': [self.x, self.y]}
+                      if self.x is not None else None),
+        }
+
+
+class AutocompleteIndex(object):
+    """In-memory prefix index of the names of published destinations, events, and tours.
+
+    Keeps a sorted array of every suffix of each normalized name that starts at a word, so that
+    a prefix of any word in a name is found by bisecting the array.
+    """
+
+    def __init__(self, version, suggestions):
+        self.version = version
+        self.suggestions = suggestions
+        keys = []
+        for i, suggestion in enumerate(suggestions):
+            name = normalize(suggestion.name)
+            for match in re.finditer(r'\S+', name):
+                keys.append((name[match.start():], match.start() == 0, i))
+        keys.sort()
+        self.keys = [key for key, _, _ in keys]
+        self.entries = [(at_start, i) for _, at_start, i in keys]
+
+    @classmethod
+    def build(cls, version):
+        """Load published destinations and events and tours from the database."""
+        suggestions = [Suggestion(pk, 'destination', name, priority, point)
+                       for pk, name, priority, point in (Destination.objects.published()
+                                                         .values_list('pk', 'name', 'priority',
+                                                                      'point'))]
+
+        # events and tours are located at their first destination
+        events = Event.objects.filter(published=True, end_date__gte=now()).prefetch_related(
+            Prefetch('event_destinations',
+                     queryset=EventDestination.objects.select_related('destination')))
+        for event in events:
+            event_destinations = event.event_destinations.all()
+            point = event_destinations[0].destination.point if event_destinations else None
+            suggestions.append(Suggestion(event.pk, 'event', event.name, event.priority, point,
+                                          event.end_date))
+
+        tours = Tour.objects.published().prefetch_related(
+            Prefetch('tour_destinations',
+                     queryset=TourDestination.objects.select_related('destination')))
+        for tour in tours:
+            tour_destinations = tour.tour_destinations.all()
+            point = tour_destinations[0].destination.point if tour_destinations else None
+            suggestions.append(Suggestion(tour.pk, 'tour', tour.name, tour.priority, point))
+
+        logger.debug('Built autocomplete index of %d names', len(suggestions))
+        return cls(version, suggestions)
+
+    def suggest(self, text, limit):
+        """Find names with a word starting with the given text.
+
+        :param text: Text to complete
+        :param limit: Maximum number of suggestions to return
+        :returns: List of suggestions; those with names starting with the text come first, then
+                  each group is ordered by priority, then by name
+        """
+        prefix = normalize(text)
+        if not prefix:
+            return []
+        current_time = now()
+
+        matched = {}
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[i].startswith(prefix):
+                break
+            at_start, index = self.entries[i]
+            suggestion = self.suggestions[index]
+            if suggestion.end_date and suggestion.end_date < current_time:
+                # event has ended since the index was built
+                continue
+            matched[index] = matched.get(index, False) or at_start
+
+        ranked = sorted(matched.items(), key=lambda item: (not item[1],
+                                                           self.suggestions[item[0]].priority,
+                                                           self.suggestions[item[0]].name))
+        return [self.suggestions[index] for index, _ in ranked[:limit]]
+
+
+_index = None
+_index_checked = 0
+_index_lock = threading.Lock()
+
+
+def get_autocomplete_index():
+    """Returns the autocomplete index for this process, rebuilding it if content has changed.
+
+    The content version is checked at most every `VERSION_CHECK_INTERVAL` seconds.
+    """
+    global _index, _index_checked
+    with _index_lock:
+        if _index is not None and time.monotonic() - _index_checked < VERSION_CHECK_INTERVAL:
+            return _index
+        version = get_content_version()
+        if _index is None or _index.version != version:
+            _index = AutocompleteIndex.build(version)
+        _index_checked = time.monotonic()
+        return _index
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import Centroid, SnapToGrid
+from django.contrib.gis.geos import Polygon
+from django.db.models import Count, Min
+
+from .isochrones import TILE_DEGREES
+
+
+def parse_bbox(bbox):
+    """Parse a bounding box parameter.
+
+    :param bbox: Comma-separated string of min longitude, min latitude, max longitude, and max
+                 latitude
+    :returns: Polygon of the bounding box
+    :raises ValueError: if the bounding box is malformed or empty
+    """
+    coords = [float(coord) for coord in bbox.split(',')]
+    if len(coords) != 4:
+        raise ValueError('bbox must have four coordinates')
+    min_lon, min_lat, max_lon, max_lat = coords
+    if min_lon >= max_lon or min_lat >= max_lat:
+        raise ValueError('bbox minimums must be less than its maximums')
+    polygon = Polygon.from_bbox(coords)
+    polygon.srid = 4326
+    return polygon
+
+
+def cluster_cell_size(zoom):
+    """Width in degrees of the grid cells destinations are clustered by at a zoom level."""
+    return settings.CLUSTER_CELL_PIXELS * TILE_DEGREES / (256 * 2 ** zoom)
+
+
+def cluster_destinations(destinations, zoom):
+    """Group destinations into clusters, by the cell of a grid they fall in.
+
+    The grid is aligned to the origin rather than the viewport, so clusters don't shift as the
+    map is panned. Clustering is done in the database, so only one row per cell is loaded.
+
+    :param destinations: Queryset of destinations
+    :param zoom: Web map zoom level the clusters will be displayed at
+    :returns: List of clusters, each a dictionary with the `count` of its destinations and the
+              `point` at their center, and for clusters of one destination, its `id`
+    """
+    cells = (destinations.annotate(cell=SnapToGrid('point', cluster_cell_size(zoom)))
+                         .values('cell')
+                         .annotate(count=Count('id', distinct=True),
+                                   first_id=Min('id'),
+                                   center=Centroid(Collect('point')))
+                         .order_by('cell'))
+    clusters = []
+    for cell in cells:
+        cluster = {
+            'count': cell['count'],
+            'point': {'type': 'Point', 'coordinates': [cell['center'].x, cell['center'].y]},
+        }
+        if cell['count'] == 1:
+            cluster['id'] = cell['first_id']
+        clusters.append(cluster)
+    return clusters
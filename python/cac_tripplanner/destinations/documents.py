@@ -0,0 +1,134 @@
+from functools import partial
+import hashlib
+import json
+
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+
+from cac_tripplanner.content_version import get_content_version
+
+from .models import Destination, Event, Tour
+from .serializers import serialize_destinations, serialize_events, serialize_tours
+
+# Documents are keyed on the content version, so are replaced as soon as any content changes;
+# the timeout only limits how long documents for past versions take up space in the cache.
+DOCUMENT_TIMEOUT = 60 * 60 * 24
+
+
+def encode(value):
+    """Encode a value as JSON bytes, the same way `JsonResponse` would."""
+    return json.dumps(value, cls=DjangoJSONEncoder).encode('utf-8')
+
+
+def document_key(kind, pk, version):
+    return 'document:{kind}:{pk}:{version}'.format(kind=kind, pk=pk, version=version)
+
+
+def get_documents(kind, pks, load, serialize):
+    """Get the pre-encoded JSON documents for a batch of objects.
+
+    Documents are kept in the content cache for the current content version, which the signals in
+    `destinations.signals` bump whenever destinations, events, or tours (or anything serialized
+    with them) are saved or published, so that any out-of-date document is re-serialized on its
+    next use.
+
+    :param kind: Name of the kind of object, for cache keys
+    :param pks: List of the primary keys of the objects
+    :param load: Callable taking a list of primary keys of objects without cached documents,
+                 returning a dictionary of those objects by primary key
+    :param serialize: Callable taking a list of the objects, returning a list of dictionaries
+    :returns: List of JSON documents, as bytes, in the same order as `pks`; None for any object
+              that could not be loaded (if it has been deleted)
+    """
+    cache = caches['content']
+    version = get_content_version()
+    keys = [document_key(kind, pk, version) for pk in pks]
+    documents = cache.get_many(keys)
+
+    missing = [(key, pk) for key, pk in zip(keys, pks) if key not in documents]
+    if missing:
+        objects = load([pk for _, pk in missing])
+        missing = [(key, objects[pk]) for key, pk in missing if pk in objects]
+        serialized = serialize([obj for _, obj in missing])
+        new_documents = {key: encode(obj) for (key, _), obj in zip(missing, serialized)}
+        cache.set_many(new_documents, timeout=DOCUMENT_TIMEOUT)
+        documents.update(new_documents)
+
+    return [documents.get(key) for key in keys]
+
+
+def object_documents(kind, objects, serialize):
+    """Get the pre-encoded JSON documents for a batch of already-loaded objects."""
+    objects = list(objects)
+    by_pk = {obj.pk: obj for obj in objects}
+    return get_documents(kind, [obj.pk for obj in objects],
+                         lambda pks: {pk: by_pk[pk] for pk in pks}, serialize)
+
+
+def fields_kind(kind, fields):
+    """Name of the kind of document for serializing only some fields of an object."""
+    if fields is None:
+        return kind
+    digest = hashlib.md5(','.join(sorted(fields)).encode('utf-8')).hexdigest()
+    return '{kind}:{digest}'.format(kind=kind, digest=digest)
+
+
+def destination_documents(destinations, fields=None):
+    return object_documents(fields_kind('destination', fields), destinations,
+                            partial(serialize_destinations, fields=fields))
+
+
+def event_documents(events, fields=None):
+    return object_documents(fields_kind('event', fields), events,
+                            partial(serialize_events, fields=fields))
+
+
+def tour_documents(tours, fields=None):
+    return object_documents(fields_kind('tour', fields), tours,
+                            partial(serialize_tours, fields=fields))
+
+
+def destination_documents_by_id(pks, fields=None):
+    return get_documents(fields_kind('destination', fields), pks, Destination.objects.in_bulk,
+                         partial(serialize_destinations, fields=fields))
+
+
+def event_documents_by_id(pks, fields=None):
+    return get_documents(fields_kind('event', fields), pks, Event.objects.in_bulk,
+                         partial(serialize_events, fields=fields))
+
+
+def tour_documents_by_id(pks, fields=None):
+    return get_documents(fields_kind('tour', fields), pks, Tour.objects.in_bulk,
+                         partial(serialize_tours, fields=fields))
+
+
+def add_properties(document, properties):
+    """Add properties to a JSON object document, without decoding it.
+
+    :param document: JSON document of an object, as bytes
+    :param properties: Dictionary of properties to add; must not already be in the document
+    :returns: JSON document with the added properties, as bytes
+    """
+    if document == b'{}':
+        # i.e. when only added properties were requested
+        return encode(properties)
+    return document[:-1] + b', ' + encode(properties)[1:]
+
+
+def encode_object(members):
+    """Encode a JSON object, some of whose members are already-encoded documents.
+
+    :param members: List of (name, value) pairs, where values are either bytes (a pre-encoded
+                    document), a list of bytes (an array of pre-encoded documents), or any other
+                    JSON-serializable value
+    :returns: JSON document, as bytes
+    """
+    parts = []
+    for name, value in members:
+        if isinstance(value, list) and all(isinstance(x, bytes) for x in value):
+            value = b'[' + b', '.join(value) + b']'
+        elif not isinstance(value, bytes):
+            value = encode(value)
+        parts.append(encode(name) + b': ' + value)
+    return b'{' + b', '.join(parts) + b'}'
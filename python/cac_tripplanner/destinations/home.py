@@ -0,0 +1,126 @@
+from itertools import groupby
+
+from django.core.cache import caches
+from django.db.models import Prefetch
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.timezone import now
+
+from cac_tripplanner.content_version import get_content_version
+
+from .models import (shuffled_ids,
+                     Destination,
+                     Event,
+                     EventDestination,
+                     Tour,
+                     TourDestination)
+
+# Listings and cards are keyed on the content version, so are replaced as soon as any content
+# changes; the timeout only limits how long those for past versions take up space in the cache.
+HOME_TIMEOUT = 60 * 60 * 24
+
+PLACE_CARD_TEMPLATE = 'partials/place-card.html'
+
+
+def card_querysets():
+    """Querysets of each kind of object shown in cards, loading what the card template uses."""
+    return {
+        'destination': Destination.objects.prefetch_related('activities'),
+        'event': Event.objects.with_summaries().prefetch_related(
+            'activities',
+            Prefetch('event_destinations',
+                     queryset=EventDestination.objects.select_related('destination'))),
+        'tour': Tour.objects.with_summaries().prefetch_related(
+            Prefetch('tour_destinations',
+                     queryset=TourDestination.objects.select_related('destination')
+                                                     .prefetch_related('destination__activities'))),
+    }
+
+
+def build_home_listing():
+    return {
+        'destinations': list(Destination.objects.published()
+                             .order_by('priority', 'id').values_list('pk', 'priority')),
+        # events that have ended are filtered out when the listing is used
+        'events': list(Event.objects.filter(published=True)
+                       .order_by('priority', 'start_date', 'id')
+                       .values_list('pk', 'end_date')),
+        'tours': list(Tour.objects.published()
+                      .order_by('priority', 'id').values_list('pk', 'priority')),
+    }
+
+
+def get_home_listing():
+    """Get the IDs of the published destinations, events, and tours, from the content cache.
+
+    :returns: Dictionary of lists of (ID, priority) of destinations and tours, and (ID, end date)
+              of events, each in order of priority
+    """
+    key = 'home_listing:{version}'.format(version=get_content_version())
+    return caches['content'].get_or_set(key, build_home_listing, timeout=HOME_TIMEOUT)
+
+
+def shuffle_ties(items, model):
+    """Order (ID, priority) pairs with the same priority by `shuffled_ids`, like `shuffled()`.
+
+    :returns: List of IDs
+    """
+    positions = {pk: i for i, pk in enumerate(shuffled_ids(model))}
+    shuffled = []
+    for _, tied in groupby(items, key=lambda item: item[1]):
+        shuffled.extend(sorted((pk for pk, _ in tied),
+                               key=lambda pk: (positions.get(pk, len(positions)), pk)))
+    return shuffled
+
+
+def home_places():
+    """Choose the destinations, events, and tours to list on the home page.
+
+    Returns one tour and one event each, unless there aren't any of one kind, then two of the
+    other, then every published destination.
+
+    :returns: List of (kind, ID) pairs, in the order to list them
+    """
+    listing = get_home_listing()
+    current_time = now()
+    events = [pk for pk, end_date in listing['events'] if end_date >= current_time][:2]
+    tours = shuffle_ties(listing['tours'], Tour)[:2]
+    if len(events) > 0 and len(tours) > 0:
+        events = events[0:1]
+        tours = tours[0:1]
+    return ([('event', pk) for pk in events] +
+            [('tour', pk) for pk in tours] +
+            [('destination', pk) for pk in shuffle_ties(listing['destinations'], Destination)])
+
+
+def place_card_key(kind, pk, version):
+    return 'place_card:{kind}:{pk}:{version}'.format(kind=kind, pk=pk, version=version)
+
+
+def get_place_cards(places):
+    """Get the rendered home page cards of destinations, events, and tours.
+
+    Cards are kept in the content cache for the current content version; only those not cached are
+    loaded from the database and rendered.
+
+    :param places: List of (kind, ID) pairs, from `home_places`
+    :returns: List of card HTML, in the same order; objects that could not be loaded are left out
+    """
+    cache = caches['content']
+    version = get_content_version()
+    keys = [place_card_key(kind, pk, version) for kind, pk in places]
+    cards = cache.get_many(keys)
+
+    missing = [(key, kind, pk) for key, (kind, pk) in zip(keys, places) if key not in cards]
+    if missing:
+        new_cards = {}
+        for kind, queryset in card_querysets().items():
+            objects = queryset.in_bulk([pk for _, k, pk in missing if k == kind])
+            for key, k, pk in missing:
+                if k == kind and pk in objects:
+                    new_cards[key] = str(render_to_string(PLACE_CARD_TEMPLATE,
+                                                          {'destination': objects[pk]}))
+        cache.set_many(new_cards, timeout=HOME_TIMEOUT)
+        cards.update(new_cards)
+
+    return [mark_safe(cards[key]) for key in keys if key in cards]
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+from math import log2
+import uuid
+
+from django.conf import settings
+from django.contrib.gis.geos import GeometryCollection, GEOSGeometry
+from django.core.cache import caches
+
+from cac_tripplanner.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Query parameters that only filter the matched destinations or control the format of the
+# response, and so do not affect the isochrone
+NON_ISOCHRONE_PARAMS = ('categories', 'encoding', 'zoom')
+
+# Compact encodings of the isochrone geometry that clients may request. Default is plain GeoJSON.
+POLYLINE_ENCODING = 'polyline'
+ISOCHRONE_ENCODINGS = (POLYLINE_ENCODING,)
+
+# Width in degrees of a 256 pixel web map tile at zoom level 0
+TILE_DEGREES = 360.0
+
+# Key in the stamps cache for the stamp that invalidates all cached isochrones when changed
+ISOCHRONE_GENERATION_KEY = 'isochrone_generation'
+
+# Concurrent requests for the same isochrone wait on a single request to OTP. The lock is held
+# for as long as the OTP client may take over the request, retries included, which is bounded by
+# its deadline; the connect timeout is allowed again on top, for handling the response.
+isochrone_flights = SingleFlight('isochrone_flight',
+                                 lock_timeout=settings.OTP_DEADLINE_S +
+                                 settings.OTP_CONNECT_TIMEOUT_S)
+
+# Time format sent by the explore UI (moment.js 'hh:mma'), i.e. '07:30am'
+ISOCHRONE_TIME_FORMAT = '%I:%M%p'
+
+
+def snap_origin(from_place):
+    """Round a 'lat,lon' origin string to the isochrone cache grid.
+
+    :param from_place: String of comma-separated latitude and longitude
+    :returns: Snapped origin string, or the original string if it could not be parsed
+    """
+    precision = settings.ISOCHRONE_CACHE_ORIGIN_PRECISION
+    try:
+        lat, lon = [round(float(coord), precision) for coord in from_place.split(',')]
+    except ValueError:
+        return from_place
+    return '{lat},{lon}'.format(lat=lat, lon=lon)
+
+
+def snap_time(time_str):
+    """Round a departure time string down to the start of its isochrone cache window.
+
+    :param time_str: Time string formatted like '07:30am'
+    :returns: Snapped time string, or the original string if it could not be parsed
+    """
+    try:
+        time = datetime.strptime(time_str.strip().upper(), ISOCHRONE_TIME_FORMAT)
+    except ValueError:
+        return time_str
+    bucket = settings.ISOCHRONE_CACHE_TIME_BUCKET_MINUTES
+    time = time.replace(minute=time.minute - time.minute % bucket)
+    return time.strftime(ISOCHRONE_TIME_FORMAT).lower()
+
+
+def snap_isochrone_params(params):
+    """Snap the origin and departure time of an isochrone query to the cache grid.
+
+    The snapped parameters are also what get sent to OTP, so that a cached isochrone is the same
+    regardless of which request within the grid cell and time window populated it.
+
+    :param params: QueryDict of isochrone request parameters
+    :returns: Mutable copy of params with snapped `fromPlace` and `time`
+    """
+    params = params.copy()
+    if params.get('fromPlace'):
+        params['fromPlace'] = snap_origin(params['fromPlace'])
+    if params.get('time'):
+        params['time'] = snap_time(params['time'])
+    return params
+
+
+def new_isochrone_generation():
+    return uuid.uuid4().hex
+
+
+def get_isochrone_generation():
+    """Get the current isochrone cache generation stamp from the shared stamps cache.
+
+    The stamp is random rather than a counter, so if it is ever lost from the cache, the
+    replacement can't match the keys of isochrones cached under an older generation.
+    """
+    return caches['stamps'].get_or_set(ISOCHRONE_GENERATION_KEY, new_isochrone_generation,
+                                       timeout=None)
+
+
+def isochrone_cache_key(params):
+    """Build the cache key for a set of (snapped) isochrone request parameters.
+
+    The key covers every parameter that is passed through to OTP (origin, mode, date, time,
+    cutoffSec, etc.), plus the cache generation.
+    """
+    parts = ['{key}={values}'.format(key=key, values=','.join(sorted(values)))
+             for key, values in sorted(params.lists()) if key not in NON_ISOCHRONE_PARAMS]
+    digest = hashlib.md5('&'.join(parts).encode('utf-8')).hexdigest()
+    return 'isochrone:{generation}:{digest}'.format(generation=get_isochrone_generation(),
+                                                    digest=digest)
+
+
+def get_cached_isochrone(cache_key):
+    """Returns the cached isochrone GeoJSON for the given key, or None if not cached."""
+    return caches['isochrones'].get(cache_key)
+
+
+def cache_isochrone(cache_key, json_poly):
+    """Store isochrone GeoJSON returned by OTP under the given key."""
+    caches['isochrones'].set(cache_key, json_poly)
+
+
+def flush_isochrone_cache():
+    """Invalidate all cached isochrones, for example after a new OTP graph is deployed.
+
+    Replaces the generation in the shared stamps cache so that entries held by other workers are no
+    longer used (and are aged out of their caches), and clears this process' cache outright.
+    """
+    caches['stamps'].set(ISOCHRONE_GENERATION_KEY, new_isochrone_generation(), timeout=None)
+    caches['isochrones'].clear()
+    logger.info('Flushed isochrone cache')
+
+
+def parse_cutoffs(params):
+    """Get the travel time cutoffs requested for an isochrone.
+
+    Cutoffs may be sent as a repeated `cutoffSec` param, or comma-separated in one param.
+
+    :param params: QueryDict of isochrone request parameters
+    :returns: Sorted list of distinct integer cutoffs, in seconds
+    :raises ValueError: if any cutoff is not an integer
+    """
+    cutoffs = set()
+    for value in params.getlist('cutoffSec'):
+        cutoffs.update(int(cutoff) for cutoff in value.split(',') if cutoff.strip())
+    return sorted(cutoffs)
+
+
+def isochrone_bands(json_poly, cutoffs):
+    """Combine the features of an isochrone into one geometry per travel time cutoff.
+
+    OTP returns a feature per cutoff, with the cutoff in its `time` property. Bands are nested,
+    so each contains all smaller ones.
+
+    :param json_poly: Isochrone GeoJSON FeatureCollection from OTP
+    :param cutoffs: Sorted list of the requested cutoffs, in seconds
+    :returns: List of (cutoff, GEOS geometry) tuples, from smallest cutoff to largest
+    """
+    geometries = {}
+    for feature in json_poly.get('features', []):
+        time = (feature.get('properties') or {}).get('time')
+        # without a time, can't tell which band a feature belongs to, so use the outermost
+        cutoff = int(time) if time in cutoffs else cutoffs[-1]
+        geometries.setdefault(cutoff, []).append(
+            GEOSGeometry(json.dumps(feature['geometry']), srid=4326))
+    return [(cutoff, GeometryCollection(*geometries[cutoff], srid=4326).unary_union)
+            for cutoff in cutoffs if cutoff in geometries]
+
+
+def estimate_zoom(cutoff_sec):
+    """Estimate the zoom level a travelshed will be displayed at, from its travel time.
+
+    The explore map zooms to fit the isochrone; a 15 minute travelshed fits at about zoom 13,
+    and each doubling of the travel time roughly doubles its extent.
+    """
+    zoom = 13 - log2(max(cutoff_sec, 1) / 900)
+    return min(max(round(zoom), 10), 16)
+
+
+def isochrone_simplify_tolerance(cutoff_sec, zoom=None):
+    """Simplification tolerance, in degrees, for an isochrone to be displayed at a zoom level.
+
+    :param cutoff_sec: Travel time of the isochrone, used to estimate zoom if not given
+    :param zoom: Web map zoom level the isochrone will be displayed at
+    :returns: Tolerance of ISOCHRONE_SIMPLIFY_PIXELS at the zoom level, in degrees
+    """
+    if zoom is None:
+        zoom = estimate_zoom(cutoff_sec)
+    return settings.ISOCHRONE_SIMPLIFY_PIXELS * TILE_DEGREES / (256 * 2 ** zoom)
+
+
+def round_coordinates(coordinates, precision):
+    """Round nested GeoJSON coordinate arrays to the given number of decimal places."""
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        return [round(coord, precision) for coord in coordinates]
+    return [round_coordinates(child, precision) for child in coordinates]
+
+
+def encode_polyline(ring, precision):
+    """Encode a GeoJSON coordinate ring with the Google encoded polyline algorithm.
+
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    Note that, per the algorithm, each point is encoded as latitude then longitude.
+    """
+    factor = 10 ** precision
+    encoded = []
+    last_lat, last_lon = 0, 0
+    for lon, lat in ring:
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat - last_lat, lon - last_lon):
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                encoded.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            encoded.append(chr(delta + 63))
+        last_lat, last_lon = lat, lon
+    return ''.join(encoded)
+
+
+def encode_polylines(coordinates, precision):
+    """Replace each ring in nested GeoJSON polygon coordinates with its encoded polyline."""
+    if coordinates and isinstance(coordinates[0][0], (int, float)):
+        return encode_polyline(coordinates, precision)
+    return [encode_polylines(child, precision) for child in coordinates]
+
+
+def simplify_isochrone(json_poly, tolerance, encoding=None):
+    """Simplify isochrone geometry for display, and optionally encode it compactly.
+
+    Geometries are simplified preserving topology, so rings don't collapse or cross, and
+    coordinates are rounded to ISOCHRONE_COORDINATE_PRECISION decimal places.
+
+    :param json_poly: Isochrone GeoJSON FeatureCollection from OTP
+    :param tolerance: Simplification tolerance, in degrees
+    :param encoding: Optional compact encoding; with 'polyline', each ring of the geometry
+                     coordinates is an encoded polyline string, and the geometry has an
+                     `encoding` property set
+    :returns: New FeatureCollection with simplified geometries
+    """
+    if not json_poly.get('features'):
+        return json_poly
+    precision = settings.ISOCHRONE_COORDINATE_PRECISION
+    features = []
+    for feature in json_poly['features']:
+        geom = GEOSGeometry(json.dumps(feature['geometry']), srid=4326)
+        geometry = json.loads(geom.simplify(tolerance, preserve_topology=True).json)
+        if encoding == POLYLINE_ENCODING:
+            geometry['coordinates'] = encode_polylines(geometry['coordinates'], precision)
+            geometry['encoding'] = POLYLINE_ENCODING
+        else:
+            geometry['coordinates'] = round_coordinates(geometry['coordinates'], precision)
+        features.append(dict(feature, geometry=geometry))
+    return dict(json_poly, features=features)
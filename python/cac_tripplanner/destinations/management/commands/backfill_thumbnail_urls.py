@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from destinations.thumbnails import store_thumbnail_urls, THUMBNAILS
+
+
+class Command(BaseCommand):
+    help = 'Generate and store thumbnail URLs for all existing images served by the API'
+
+    def handle(self, *args, **options):
+        for model in THUMBNAILS:
+            count = 0
+            for obj in model.objects.all().order_by('pk').iterator():
+                store_thumbnail_urls(obj)
+                count += 1
+            self.stdout.write('Stored thumbnail URLs for {count} {model}'.format(
+                count=count, model=model._meta.verbose_name_plural))
+        self.stdout.write(self.style.SUCCESS('Thumbnail URLs backfilled'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from destinations.isochrones import flush_isochrone_cache
+
+
+class Command(BaseCommand):
+    help = 'Invalidate cached isochrones; run after deploying a new OTP Graph.obj'
+
+    def handle(self, *args, **options):
+        flush_isochrone_cache()
+        self.stdout.write(self.style.SUCCESS('Isochrone cache flushed'))
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def set_explorable(apps, schema_editor):
+    """ Flag destinations that are published, or are in a published tour or event """
+    Destination = apps.get_model('destinations', 'Destination')
+    explorable = Destination.objects.filter(
+        Q(published=True) |
+        Q(tours__related_tour__published=True) |
+        Q(events__related_event__published=True)).values('pk')
+    Destination.objects.filter(pk__in=explorable).update(explorable=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0059_auto_20190917_1516'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='destination',
+            name='explorable',
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+        migrations.RunPython(set_explorable, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0060_destination_explorable'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailURL',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='Name of the uploaded image file', max_length=255)),
+                ('size', models.CharField(max_length=16)),
+                ('box', models.CharField(blank=True, help_text='Crop box for this thumbnail', max_length=255)),
+                ('url', models.CharField(max_length=1024)),
+            ],
+            options={
+                'unique_together': {('source', 'size')},
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0061_thumbnailurl'),
+    ]
+
+    operations = [TrigramExtension()] + [
+        operation
+        for model_name in ('destination', 'event', 'tour')
+        for operation in (
+            migrations.AddIndex(
+                model_name=model_name,
+                index=django.contrib.postgres.indexes.GinIndex(
+                    django.contrib.postgres.indexes.OpClass(
+                        django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'),
+                    name=model_name + '_name_upper_trgm'),
+            ),
+            migrations.AddIndex(
+                model_name=model_name,
+                index=django.contrib.postgres.indexes.GinIndex(
+                    fields=['name'], name=model_name + '_name_trgm', opclasses=['gin_trgm_ops']),
+            ),
+            migrations.AddIndex(
+                model_name=model_name,
+                index=django.contrib.postgres.indexes.GinIndex(
+                    django.contrib.postgres.search.SearchVector(
+                        'name', 'description', config='english'),
+                    name=model_name + '_search'),
+            ),
+        )
+    ]
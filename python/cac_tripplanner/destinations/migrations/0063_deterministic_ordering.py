@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0062_text_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='destination',
+            options={'ordering': ['priority', 'id']},
+        ),
+        migrations.AlterModelOptions(
+            name='tour',
+            options={'ordering': ['priority', 'id']},
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0063_deterministic_ordering'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='thumbnailurl',
+            unique_together={('source', 'size', 'box')},
+        ),
+    ]
@@ -0,0 +1,22 @@
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.indexes
+from django.db import migrations
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('destinations', '0064_thumbnailurl_unique_box'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='destination',
+            index=django.contrib.postgres.indexes.GistIndex(
+                django.db.models.functions.comparison.Cast(
+                    'point',
+                    output_field=django.contrib.gis.db.models.fields.PointField(geography=True)),
+                name='destination_point_geography'),
+        ),
+    ]
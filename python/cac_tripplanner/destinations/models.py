@@ -1,16 +1,24 @@
 import logging
+import random
+import time
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.db import models
-from django.db.models import Count, Manager as GeoManager, OuterRef, Subquery
-from django.db.models.functions import Coalesce
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, GistIndex, OpClass
+from django.contrib.postgres.search import SearchVector
+from django.core.cache import caches
+from django.db.models import (Count, Exists, F, Func, IntegerField, Manager as GeoManager,
+                              OuterRef, Q, Subquery, Value)
+from django.db.models.functions import Cast, Coalesce, Upper
 from django.utils.timezone import get_current_timezone, now
 
 from ckeditor.fields import RichTextField
 from image_cropping import ImageCropField, ImageRatioField
 
+from cac_tripplanner.content_version import get_content_version
 from cac_tripplanner.image_utils import generate_image_filename
 
 NARROW_IMAGE_DIMENSIONS = (310, 155)
@@ -18,6 +26,12 @@ WIDE_IMAGE_DIMENSIONS = (680, 400)
 NARROW_IMAGE_DIMENSION_STRING = 'x'.join([str(x) for x in NARROW_IMAGE_DIMENSIONS])
 WIDE_IMAGE_DIMENSION_STRING = 'x'.join([str(x) for x in WIDE_IMAGE_DIMENSIONS])
 
+# Text search configuration for the full-text search indexes; see `destinations.search`
+SEARCH_CONFIG = 'english'
+
+# Seconds between reshuffles of objects with the same priority; see `ShuffledQuerySet`
+SHUFFLE_PERIOD = 60 * 60
+
 logger = logging.getLogger(__name__)
 
 
@@ -26,14 +40,149 @@ def generate_filename(instance, filename):
     return generate_image_filename('destinations', instance, filename)
 
 
-class DestinationManager(GeoManager):
+def search_vector():
+    """Full-text search document of an object's name and description.
+
+    Queries must use this same expression to use the indexes from `text_search_indexes`.
+    """
+    return SearchVector('name', 'description', config=SEARCH_CONFIG)
+
+
+def text_search_indexes(prefix):
+    """Indexes for searching by name and description, for models with those fields.
+
+    Trigram indexes on the name support substring (`icontains`) and typo-tolerant (trigram word
+    similarity) matching, and an expression index supports full-text search.
+
+    :param prefix: Prefix for the index names
+    :returns: List of indexes for the model's `Meta.indexes`
+    """
+    return [
+        GinIndex(OpClass(Upper('name'), name='gin_trgm_ops'), name=prefix + '_name_upper_trgm'),
+        GinIndex(fields=['name'], opclasses=['gin_trgm_ops'], name=prefix + '_name_trgm'),
+        GinIndex(search_vector(), name=prefix + '_search'),
+    ]
+
+
+def geography_point():
+    """A destination's point as geography, so that distances from it are in meters.
+
+    Queries must use this same expression to use the index on it from `Destination.Meta.indexes`.
+    """
+    return Cast('point', models.PointField(geography=True))
+
+
+def shuffled_ids(model):
+    """Returns the IDs of all objects of a model in a random order, which changes periodically.
+
+    The order is chosen once per `SHUFFLE_PERIOD` (and whenever content changes) and kept in the
+    shared cache, so that every query and page in that time sees the same order.
+    """
+    key = 'shuffled_ids:{model}:{version}:{period}'.format(
+        model=model._meta.label_lower, version=get_content_version(),
+        period=int(time.time() // SHUFFLE_PERIOD))
+
+    def shuffle():
+        ids = list(model._base_manager.values_list('pk', flat=True))
+        random.shuffle(ids)
+        return ids
+
+    return caches['default'].get_or_set(key, shuffle, timeout=SHUFFLE_PERIOD)
+
+
+class ShuffledQuerySet(models.QuerySet):
+
+    def shuffled(self):
+        """Order by priority, with ties broken by the periodically changing `shuffled_ids` order.
+
+        Use instead of ordering randomly, which sorts every matching row on each query.
+        """
+        # psycopg2 would inline a list as an ARRAY[...] expression of one constant per ID, so the
+        # order is sent as a single array literal parameter, and parsed as one value
+        order = '{' + ','.join(str(pk) for pk in shuffled_ids(self.model)) + '}'
+        position = Func(Cast(Value(order, output_field=models.TextField()),
+                             ArrayField(IntegerField())),
+                        F('pk'), function='array_position', output_field=IntegerField())
+        # objects added since the order was chosen come last among their priority
+        return self.order_by('priority', position, 'pk')
+
+
+def first_destination_id(ordered_destination_model, related_field):
+    """Subquery of the ID of the first ordered destination of an event or tour.
+
+    :param ordered_destination_model: EventDestination or TourDestination
+    :param related_field: Name of its field relating it to the event or tour
+    """
+    ordered = ordered_destination_model.objects.filter(**{related_field: OuterRef('pk')})
+    return Subquery(ordered.order_by(*ordered_destination_model._meta.ordering)
+                           .values('destination_id')[:1])
+
+
+def get_first_destination(obj, ordered_destinations):
+    """Returns the first ordered destination of an event or tour.
+
+    Uses the destinations loaded by `prefetch_first_destinations` or prefetched with the
+    event's or tour's ordered destinations, if either have been, or else queries for it.
+    """
+    if hasattr(obj, '_first_destination'):
+        return obj._first_destination
+    if getattr(obj, 'first_destination_id', True) is None:
+        # annotated by `with_summaries`, and there isn't one
+        return None
+    try:
+        return ordered_destinations.first().destination
+    except AttributeError:
+        return None
+
+
+def prefetch_first_destinations(objects):
+    """Load the first destinations of events or tours annotated by `with_summaries` in one query.
+
+    :param objects: List of events or tours
+    """
+    destinations = Destination.objects.in_bulk({obj.first_destination_id for obj in objects
+                                                if obj.first_destination_id is not None})
+    for obj in objects:
+        obj._first_destination = destinations.get(obj.first_destination_id)
+
+
+class EventQuerySet(ShuffledQuerySet):
+
+    def with_summaries(self):
+        """Annotate events with the ID of their first destination, for `first_destination`."""
+        return self.annotate(first_destination_id=first_destination_id(EventDestination,
+                                                                       'related_event'))
+
+
+class TourQuerySet(ShuffledQuerySet):
+
+    def with_summaries(self):
+        """Annotate tours with the values of their properties that depend on their destinations.
+
+        Used by the `accessible`, `watershed_alliance`, and `first_destination` properties in
+        place of a query for each tour.
+        """
+        tour_destinations = TourDestination.objects.filter(related_tour=OuterRef('pk'))
+        return self.annotate(
+            all_destinations_accessible=~Exists(
+                tour_destinations.filter(destination__accessible=False)),
+            all_destinations_watershed_alliance=~Exists(
+                tour_destinations.filter(destination__watershed_alliance=False)),
+            first_destination_id=first_destination_id(TourDestination, 'related_tour'))
+
+
+class DestinationManager(GeoManager.from_queryset(ShuffledQuerySet)):
     """Custom manager for Destinations that allows filtering on published."""
 
     def published(self):
         return self.get_queryset().filter(published=True)
 
 
-class EventManager(DestinationManager):
+class TourManager(DestinationManager.from_queryset(TourQuerySet)):
+    """Custom manager for Tours that allows filtering on published."""
+
+
+class EventManager(DestinationManager.from_queryset(EventQuerySet)):
     """Custom manager for Events that allows filtering on published or currently ongoing."""
 
     def current(self):
@@ -156,6 +305,8 @@ class Attraction(models.Model):
 
     def has_activity(self, activity_name):
         """Helper to check if an activity of a given name is available at a destination."""
+        if 'activities' in getattr(self, '_prefetched_objects_cache', {}):
+            return any(activity.name == activity_name for activity in self.activities.all())
         return self.activities.filter(name=activity_name).exists()
 
 
@@ -166,7 +317,11 @@ class Destination(Attraction):
     """
 
     class Meta:
-        ordering = ['priority', '?']
+        ordering = ['priority', 'id']
+        indexes = text_search_indexes('destination') + [
+            # for nearest neighbor searches in meters; see `destinations.search.nearest_distance`
+            GistIndex(geography_point(), name='destination_point_geography'),
+        ]
 
     city = models.CharField(max_length=40, default='Philadelphia')
     state = models.CharField(max_length=20, default='PA')
@@ -182,6 +337,9 @@ class Destination(Attraction):
         Does this location belong to the <a target="_blank"
         href="https://www.watershedalliance.org/centers/">
         Alliance for Watershed Education</a>?""")
+    # Whether this destination is published, or is part of a published tour or event,
+    # and so should be shown in travelshed results. Maintained by `update_explorable_destinations`.
+    explorable = models.BooleanField(default=False, editable=False, db_index=True)
 
     objects = DestinationManager()
 
@@ -226,6 +384,7 @@ class Event(Attraction):
 
     class Meta:
         ordering = ['priority', '-start_date']
+        indexes = text_search_indexes('event')
 
     start_date = models.DateTimeField()
     end_date = models.DateTimeField()
@@ -238,10 +397,7 @@ class Event(Attraction):
     @property
     def first_destination(self):
         """Returns the first ordered destination for this event."""
-        try:
-            return self.event_destinations.first().destination
-        except AttributeError:
-            return None
+        return get_first_destination(self, self.event_destinations)
 
     @property
     def single_day(self):
@@ -269,6 +425,26 @@ class ExtraImage(models.Model):
         return self.image_raw.url if self.image_raw else ''
 
 
+class ThumbnailURL(models.Model):
+    """Stored URL of a cropped thumbnail of an uploaded image.
+
+    Saved when the image (or its crop box) is saved, so that serializing objects for the API does
+    not need to generate thumbnails or check for them in storage. See `destinations.thumbnails`.
+    Objects sharing an uploaded image may crop it differently, so each crop box has its own URL.
+    """
+
+    class Meta:
+        unique_together = ('source', 'size', 'box')
+
+    source = models.CharField(max_length=255, help_text='Name of the uploaded image file')
+    size = models.CharField(max_length=16)
+    box = models.CharField(max_length=255, blank=True, help_text='Crop box for this thumbnail')
+    url = models.CharField(max_length=1024)
+
+    def __str__(self):
+        return self.url
+
+
 class ExtraDestinationPicture(ExtraImage):
     destination = models.ForeignKey('Destination', on_delete=models.CASCADE)
 
@@ -377,14 +553,15 @@ class TourDestination(models.Model):
 class Tour(models.Model):
 
     class Meta:
-        ordering = ['priority', '?']
+        ordering = ['priority', 'id']
+        indexes = text_search_indexes('tour')
 
     name = models.CharField(max_length=50, unique=True)
     description = RichTextField(blank=True, null=True)
     priority = models.IntegerField(default=9999, null=False)
     published = models.BooleanField(default=False)
 
-    objects = DestinationManager()
+    objects = TourManager()
 
     def __str__(self):
         return self.name
@@ -392,20 +569,21 @@ class Tour(models.Model):
     @property
     def accessible(self):
         """Returns true if all destinations in this tour are accessible."""
+        if hasattr(self, 'all_destinations_accessible'):
+            return self.all_destinations_accessible
         return not self.tour_destinations.filter(destination__accessible=False).exists()
 
     @property
     def watershed_alliance(self):
         """Returns true if all destinations in this tour are in the Watershed Alliance."""
+        if hasattr(self, 'all_destinations_watershed_alliance'):
+            return self.all_destinations_watershed_alliance
         return not self.tour_destinations.filter(destination__watershed_alliance=False).exists()
 
     @property
     def first_destination(self):
         """Returns the first ordered destination for this tour."""
-        try:
-            return self.tour_destinations.first().destination
-        except AttributeError:
-            return None
+        return get_first_destination(self, self.tour_destinations)
 
     @property
     def is_event(self):
@@ -418,7 +596,21 @@ class Tour(models.Model):
     def has_activity(self, activity_name):
         """Helper to check if an activity of a given name is available at
         any of this tour's destinations."""
-        for td in self.tour_destinations.all():
-            if td.destination.activities.filter(name=activity_name).exists():
-                return True
-        return False
+        if 'tour_destinations' in getattr(self, '_prefetched_objects_cache', {}):
+            return any(td.destination.has_activity(activity_name)
+                       for td in self.tour_destinations.all())
+        return self.tour_destinations.filter(destination__activities__name=activity_name).exists()
+
+
+def update_explorable_destinations():
+    """Set the `explorable` flag on destinations that are published, or that are part of a
+    published tour or event, and clear it on all others.
+
+    Called when destinations, tours, or events (or their membership) change.
+    """
+    explorable = Destination.objects.filter(
+        Q(published=True) |
+        Q(tours__related_tour__published=True) |
+        Q(events__related_event__published=True)).values('pk')
+    Destination.objects.filter(pk__in=explorable, explorable=False).update(explorable=True)
+    Destination.objects.exclude(pk__in=explorable).filter(explorable=True).update(explorable=False)
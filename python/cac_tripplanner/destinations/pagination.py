@@ -0,0 +1,122 @@
+import base64
+import binascii
+from datetime import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+# Types of the ordering values that may be put in a cursor (bool being a subclass of int)
+CURSOR_VALUE_TYPES = (str, int, float)
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(positions):
+    """Encode the positions reached in each list of results as an opaque cursor string.
+
+    :param positions: Dictionary of list name to the ordering values of the last result returned
+                      from that list, or None if the list has been exhausted
+    :returns: Cursor string, or None if every list has been exhausted
+    """
+    if all(position is None for position in positions.values()):
+        return None
+    encoded = json.dumps(positions, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(encoded.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor string made by `encode_cursor`.
+
+    :param cursor: Cursor string; an empty string is the cursor for the first page
+    :returns: Dictionary of list name to position; lists not in it start from the beginning
+    :raises InvalidCursorError: if the cursor is malformed, or any position is not a list of
+                                ordering values (or None)
+    """
+    if not cursor:
+        return {}
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise InvalidCursorError(str(e))
+    if not isinstance(positions, dict):
+        raise InvalidCursorError('Cursor must encode an object')
+    for name, position in positions.items():
+        if position is None:
+            continue
+        if (not isinstance(position, list) or
+                not all(isinstance(value, CURSOR_VALUE_TYPES) for value in position)):
+            raise InvalidCursorError('Invalid cursor position for {name}'.format(name=name))
+    return positions
+
+
+def keyset_after(ordering, position):
+    """Filter matching rows that come after a position, in ascending order of the given fields.
+
+    Equivalent to the row comparison `(a, b, c) > (x, y, z)`, as OR-ed lookups that can use an
+    index on the ordering, rather than skipping rows with OFFSET.
+
+    :param ordering: List of field names the rows are ordered by
+    :param position: List of the values of those fields for the last row already returned
+    :returns: Q object
+    """
+    after = Q()
+    for i, field in enumerate(ordering):
+        matching_prefix = {ordering[j]: position[j] for j in range(i)}
+        after |= Q(**matching_prefix) & Q(**{field + '__gt': position[i]})
+    return after
+
+
+def cursor_value(value):
+    """Convert the value of an ordering field of a result to a form that can be put in a cursor."""
+    if isinstance(value, datetime):
+        # keep microseconds, which DjangoJSONEncoder would truncate
+        return value.isoformat()
+    # distance annotations are measure objects
+    return value.m if hasattr(value, 'm') else value
+
+
+def page_queryset(queryset, ordering, position, page_size):
+    """Restrict results to a page, after the given position in the ordering.
+
+    The queryset is not evaluated, so that pages of several lists can be fetched in one query.
+    It includes one extra result, to tell if there is another page; see `split_page`.
+
+    :param queryset: Queryset of results
+    :param ordering: List of field names to order by; the last must be unique
+    :param position: Ordering values of the last result already returned, an empty list to start
+                     from the first result, or None if the results have been exhausted
+    :param page_size: Maximum number of results to return
+    :returns: Ordered and sliced queryset
+    :raises InvalidCursorError: if the position does not match the ordering
+    """
+    if position is None:
+        return queryset.none()
+    if not isinstance(position, list) or len(position) not in (0, len(ordering)):
+        raise InvalidCursorError('Cursor does not match the search ordering')
+    if position:
+        try:
+            queryset = queryset.filter(keyset_after(ordering, position))
+        except (TypeError, ValueError, ValidationError) as e:
+            # a value that can't be compared to its field, such as text for a number
+            raise InvalidCursorError('Cursor does not match the search ordering: {error}'.format(
+                error=e))
+    return queryset.order_by(*ordering)[:page_size + 1]
+
+
+def split_page(results, page_size, position_of):
+    """Split the results fetched by `page_queryset` into a page and the position after it.
+
+    :param results: List of the results fetched
+    :param page_size: Maximum number of results to return
+    :param position_of: Callable returning the ordering values of a result
+    :returns: Tuple of the page of results, and the position to continue from (or None if there
+              are no more results)
+    """
+    if len(results) <= page_size:
+        return results, None
+    page = results[:page_size]
+    return page, [cursor_value(value) for value in position_of(page[-1])]
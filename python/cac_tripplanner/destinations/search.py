@@ -0,0 +1,134 @@
+from django.contrib.gis.db.models import PointField
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db.models import CharField, DateTimeField, F, FloatField, Func, Q, Value
+from django.db.models.functions import Cast, Greatest
+
+from .models import Destination, geography_point, search_vector, SEARCH_CONFIG
+
+# Weight of priority in the search score. Relevance (name similarity plus full-text rank) is
+# roughly between 0 and 1; an object with priority 0 (or below) gets this much added, and one with
+# the default priority of 9999 almost nothing.
+SEARCH_PRIORITY_WEIGHT = 0.25
+
+# Ordering of text search results, best first, with ties broken by ID
+SEARCH_ORDERING = ('search_order', 'id')
+
+# Columns of the rows returned by `union_search`
+SEARCH_ROW_COLUMNS = ('result_kind', 'id', 'result_rank', 'priority', 'result_start_date',
+                      'result_distance')
+
+# Index of the column of a search row holding each field results may be ordered by
+ORDERING_COLUMNS = {
+    'id': 1,
+    'knn_distance': 2,
+    'search_order': 2,
+    'priority': 3,
+    'start_date': 4,
+}
+
+
+class GeographyDistance(Func):
+    """PostGIS `<->` operator between geographies, which orders by a spatial index.
+
+    Unlike Django's `GeometryDistance`, which on geometries in SRID 4326 gives the planar distance
+    in degrees, gives the distance in meters (on a sphere).
+    """
+    arg_joiner = ' <-> '
+    template = '(%(expressions)s)'
+    output_field = FloatField()
+
+
+def nearest_distance(point):
+    """Expression for the distance in meters of destinations from a point, to order them by.
+
+    Ordering by it finds the nearest destinations from the index on `geography_point`.
+
+    :param point: Point in SRID 4326
+    """
+    return GeographyDistance(geography_point(),
+                             Cast(Value(point, output_field=PointField()),
+                                  PointField(geography=True)))
+
+
+def text_search(queryset, text, extra_match=None):
+    """Filter objects to those matching search text, and annotate them with their relevance.
+
+    Matches objects with names containing the text, names similar to it (to tolerate typos), or
+    names or descriptions matching it as a full-text query. These are supported by the indexes
+    from `destinations.models.text_search_indexes`.
+
+    Matches are annotated with `search_order`, the negated score blending relevance and
+    priority, so that ordering by `SEARCH_ORDERING` gives the best matches first.
+
+    :param queryset: Queryset of a model with `name`, `description`, and `priority` fields
+    :param text: Search text; must not be blank
+    :param extra_match: Optional Q object of further conditions to match objects by
+    :returns: Filtered and annotated queryset
+    """
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    match = (Q(name__icontains=text) |
+             Q(name__trigram_word_similar=text) |
+             Q(search_document=query))
+    if extra_match is not None:
+        match |= extra_match
+
+    score = (TrigramWordSimilarity(text, 'name') +
+             SearchRank(F('search_document'), query) +
+             Value(SEARCH_PRIORITY_WEIGHT) / (Greatest(F('priority'), Value(0)) + Value(1.0)))
+    return (queryset.annotate(search_document=search_vector())
+                    .filter(match)
+                    .annotate(search_order=Cast(-score, output_field=FloatField())))
+
+
+def destination_text_search(queryset, text):
+    """Text search for destinations, which also matches the names of their categories."""
+    in_category = Destination.categories.through.objects.filter(
+        destinationcategory__name__icontains=text).values('destination_id')
+    return text_search(queryset, text, Q(pk__in=in_category))
+
+
+def search_rows(queryset, kind, ordering, distance=None):
+    """Select the columns of `SEARCH_ROW_COLUMNS` from a queryset of search results.
+
+    The rank column holds the result's `knn_distance` or its `search_order`, whichever its
+    ordering uses, so that the rows of destinations, events, and tours have the same columns and
+    can be combined with `union_search`.
+
+    :param queryset: Queryset of destinations, events, or tours
+    :param kind: Name of the kind of result, for the first column
+    :param ordering: List of field names the results are ordered by
+    :param distance: Optional expression for the distance of the result from the search point
+    :returns: values_list queryset
+    """
+    rank_fields = [field for field in ordering if ORDERING_COLUMNS[field] == 2]
+    empty_float = Value(None, output_field=FloatField())
+    return queryset.annotate(
+        result_kind=Value(kind, output_field=CharField()),
+        result_rank=Cast(rank_fields[0], output_field=FloatField()) if rank_fields else empty_float,
+        result_start_date=(F('start_date') if 'start_date' in ordering
+                           else Value(None, output_field=DateTimeField())),
+        result_distance=(Cast(distance, output_field=FloatField()) if distance is not None
+                         else empty_float),
+    ).values_list(*SEARCH_ROW_COLUMNS)
+
+
+def union_search(orderings, **querysets):
+    """Find the results of several searches in one query.
+
+    Each queryset keeps its own ordering and limit, as a parenthesized part of a UNION ALL.
+    That limits which rows each part returns, but Postgres doesn't guarantee that the combined
+    rows keep each part's order, so each kind's rows are sorted again here.
+
+    :param orderings: Dictionary of the kind name to the fields its results are ordered by
+                      (ascending), each of which must be in `ORDERING_COLUMNS`
+    :param querysets: Querysets from `search_rows`, by the name of their kind of result
+    :returns: Dictionary of the kind name to the list of its rows, in order
+    """
+    rows = {kind: [] for kind in querysets}
+    combined = list(querysets.values())
+    for row in combined[0].union(*combined[1:], all=True):
+        rows[row[0]].append(row)
+    for kind, kind_rows in rows.items():
+        columns = [ORDERING_COLUMNS[field] for field in orderings[kind]]
+        kind_rows.sort(key=lambda row: [row[column] for column in columns])
+    return rows
@@ -0,0 +1,341 @@
+import json
+
+from django.db.models import Prefetch, prefetch_related_objects
+from django.forms.models import model_to_dict
+from django.utils import timezone
+
+from .models import (EventDestination,
+                     ExtraDestinationPicture,
+                     ExtraEventPicture,
+                     Tour,
+                     TourDestination)
+from .thumbnails import image_to_url, prefetch_thumbnail_urls
+
+EVENT_CATEGORY = 'Events'
+TOUR_CATEGORY = 'Tours'
+
+# Properties returned for each destination, event, or tour by the summary view of the search API
+SUMMARY_FIELDS = frozenset(('id', 'name', 'is_event', 'is_tour', 'point'))
+
+IMAGE_FIELDS = ('image', 'wide_image')
+EXTRA_IMAGE_FIELDS = ('extra_images', 'extra_wide_images')
+ACTIVITY_FIELDS = ('activities', 'cycling')
+
+# Related objects used in serializing destinations, to prefetch for a batch of destinations at
+# once, with the names of the properties that use them
+DESTINATION_PREFETCHES = (
+    (('categories',), 'categories'),
+    (ACTIVITY_FIELDS, 'activities'),
+    (EXTRA_IMAGE_FIELDS, Prefetch('extradestinationpicture_set',
+                                  queryset=ExtraDestinationPicture.objects.order_by('pk'),
+                                  to_attr='extra_pictures')),
+    (('related_tours',), Prefetch('tours',
+                                  queryset=(TourDestination.objects
+                                            .filter(related_tour__published=True)
+                                            .select_related('related_tour')
+                                            .order_by('related_tour__priority',
+                                                      'related_tour__pk')),
+                                  to_attr='published_tour_destinations')),
+)
+
+# Related objects used in serializing events and tours (with None for those always used);
+# their destinations are then serialized together, once each
+EVENT_PREFETCHES = (
+    (ACTIVITY_FIELDS, 'activities'),
+    (EXTRA_IMAGE_FIELDS, Prefetch('extraeventpicture_set',
+                                  queryset=ExtraEventPicture.objects.order_by('pk'),
+                                  to_attr='extra_pictures')),
+    (None, Prefetch('event_destinations',
+                    queryset=EventDestination.objects.select_related('destination'))),
+)
+TOUR_PREFETCHES = (
+    (None, Prefetch('tour_destinations',
+                    queryset=TourDestination.objects.select_related('destination'))),
+)
+
+
+def wants(fields, *names):
+    """Helper to check whether any of the named properties are to be serialized.
+
+    :param fields: Set of names of the properties to serialize, or None to serialize all of them
+    :param names: Property names
+    :returns: True if any of the properties are to be serialized
+    """
+    return fields is None or not fields.isdisjoint(names)
+
+
+def select_fields(obj, fields):
+    """Helper to drop properties other than those requested from a serialized object."""
+    if fields is None:
+        return obj
+    return {key: value for key, value in obj.items() if key in fields}
+
+
+def get_prefetches(prefetches, fields):
+    """Returns the lookups from a list of (property names, lookup) needed for the given fields."""
+    return [lookup for names, lookup in prefetches if names is None or wants(fields, *names)]
+
+
+def set_location_properties(obj, location):
+    """Helper to set location-related properties on either destinations or events.
+
+    Events have optional related destination, which is the event location.
+
+    :param obj: Dictionary representation of object to which to add location properties
+    :param location: Destination object from which to extract location properties
+    :returns: passed obj dictionary, with added properties
+    """
+    obj['placeID'] = location.pk if location else None
+    obj['point'] = json.loads(location.point.json) if location else None
+    obj['attributes'] = {
+        'City': location.city if location else None,
+        'Postal': location.zipcode if location else None,
+        'Region': location.state if location else None,
+        'StAddr': location.address if location else None
+    }
+    # convert to format like properties on ESRI geocoder results
+    x = obj['point']['coordinates'][0] if location else None
+    y = obj['point']['coordinates'][1] if location else None
+    obj['extent'] = {'xmax': x, 'xmin': x, 'ymax': y, 'ymin': y}
+    obj['location'] = {'x': x, 'y': y}
+    return obj
+
+
+def set_attraction_properties(obj, model, extra_images, fields=None):
+    """Helper to set serialized properties common to destinations and events.
+
+    :param obj: Dictionary representation of object
+    :param model: Django model object with the expected properties of an Attraction
+    :param extra_images: Filtered queryset of `ExtraImage` related objects to the Attraction
+    :param fields: Optional set of names of the properties to serialize; others may be skipped
+    :returns: Dictionary representation of object, with added properties
+    """
+    for field_name in IMAGE_FIELDS:
+        if wants(fields, field_name):
+            obj[field_name] = image_to_url(model, field_name)
+    del obj['image_raw']
+    del obj['wide_image_raw']
+
+    # return URLs for extra images, in both narrow and wide formats
+    if wants(fields, *EXTRA_IMAGE_FIELDS):
+        extras_list = []
+        wide_extras_list = []
+        for extra in extra_images:
+            extras_list.append(image_to_url(extra, 'image'))
+            wide_extras_list.append(image_to_url(extra, 'wide_image'))
+        obj['extra_images'] = extras_list
+        obj['extra_wide_images'] = wide_extras_list
+
+    if wants(fields, *ACTIVITY_FIELDS):
+        obj['activities'] = [a.name for a in obj['activities']]
+        # add convenience property for whether destination has cycling
+        obj['cycling'] = model.has_activity('cycling')
+
+    return obj
+
+
+def attraction_to_dict(model, fields, m2m_fields):
+    """Helper to convert a model object to a dictionary, skipping unwanted many-to-many fields."""
+    return model_to_dict(model, exclude=[name for name in m2m_fields if not wants(fields, name)])
+
+
+def set_destination_properties(destination, fields=None):
+    """Helper for adding and converting properties in serializing destinations as JSON.
+
+    Uses related objects loaded by `DESTINATION_PREFETCHES`, if present; to serialize more than
+    one destination, use `serialize_destinations`.
+
+    :param destination: Destination model object
+    :param fields: Optional set of names of the properties to serialize
+    :returns: Dictionary representation of object, with added properties
+    """
+    obj = attraction_to_dict(destination, fields, ('categories', 'activities'))
+    obj['address'] = obj['name']
+    if 'categories' in obj:
+        obj['categories'] = [c.name for c in obj['categories']]
+    obj['is_event'] = False
+    obj['is_tour'] = False
+
+    # Add truncated information on related tours (just ID and name)
+    if wants(fields, 'related_tours'):
+        if hasattr(destination, 'published_tour_destinations'):
+            related_tours = [{'id': td.related_tour.id, 'name': td.related_tour.name}
+                             for td in destination.published_tour_destinations]
+        else:
+            related_tours = list(Tour.objects.filter(published=True,
+                                 tour_destinations__destination=destination).values('id', 'name'))
+        obj['related_tours'] = related_tours
+
+    if hasattr(destination, 'extra_pictures'):
+        extra_images = destination.extra_pictures
+    else:
+        extra_images = ExtraDestinationPicture.objects.filter(destination=destination)
+    obj = set_attraction_properties(obj, destination, extra_images, fields)
+    obj = set_location_properties(obj, destination)
+    return select_fields(obj, fields)
+
+
+def set_event_properties(event, destinations=None, fields=None):
+    """Helper for adding and converting properties in serializing events as JSON.
+
+    Expects the related objects in `EVENT_PREFETCHES` to have been prefetched, if `destinations`
+    is given; to serialize more than one event, use `serialize_events`.
+
+    :param event: Event model object
+    :param destinations: Dictionary of serialized destinations by ID, including those of this
+                         event. If not given, the event's related objects are loaded here.
+    :param fields: Optional set of names of the properties to serialize; nested destinations
+                   are always serialized in full
+    :returns: Dictionary representation of object, with added properties
+    """
+    if destinations is None:
+        return serialize_events([event], fields)[0]
+
+    obj = attraction_to_dict(event, fields, ('activities',))
+    obj['address'] = event.name
+
+    obj['categories'] = (EVENT_CATEGORY,)  # events are a special category
+    obj['start_date'] = timezone.localtime(event.start_date).isoformat()
+    obj['end_date'] = timezone.localtime(event.end_date).isoformat()
+    obj['is_event'] = True
+    obj['is_tour'] = False
+
+    obj = set_attraction_properties(obj, event, getattr(event, 'extra_pictures', []), fields)
+    event_destinations = list(event.event_destinations.all())
+    first_destination = event_destinations[0].destination if event_destinations else None
+    # add properties of first related destination, if any
+    obj = set_location_properties(obj, first_destination)
+    if wants(fields, 'destinations'):
+        obj['destinations'] = []
+        for x in event_destinations:
+            dest = dict(destinations[x.destination_id])
+            dest['order'] = x.order
+            # optional start/end date/times
+            dest['start_date'] = (timezone.localtime(x.start_date).isoformat()
+                                  if x.start_date else '')
+            dest['end_date'] = timezone.localtime(x.end_date).isoformat() if x.end_date else ''
+            obj['destinations'].append(dest)
+
+    # For backwards compatibility for the mobile app,
+    # still return 'destination' with the ID of the first destination, if any.
+    obj['destination'] = first_destination.id if first_destination else None
+
+    # if the first related destination belongs to Watershed Alliance, so does this event
+    obj['watershed_alliance'] = (first_destination.watershed_alliance
+                                 if first_destination else False)
+    return select_fields(obj, fields)
+
+
+def set_tour_properties(tour, destinations=None, fields=None):
+    """Helper for adding and converting properties in serializing tours as JSON.
+
+    Expects the related objects in `TOUR_PREFETCHES` to have been prefetched, if `destinations`
+    is given; to serialize more than one tour, use `serialize_tours`.
+
+    :param tour: Tour model object
+    :param destinations: Dictionary of serialized destinations by ID, including those of this
+                         tour. If not given, the tour's related objects are loaded here.
+    :param fields: Optional set of names of the properties to serialize; nested destinations
+                   are always serialized in full
+    :returns: Dictionary representation of object, with added properties
+    """
+    if destinations is None:
+        return serialize_tours([tour], fields)[0]
+
+    obj = model_to_dict(tour)
+    obj['categories'] = (TOUR_CATEGORY,)  # tours are a special category
+    tour_destinations = list(tour.tour_destinations.all())
+    # tour location is that of its first destination
+    obj = set_location_properties(obj,
+                                  tour_destinations[0].destination if tour_destinations else None)
+    obj['is_tour'] = True
+    obj['is_event'] = False
+
+    if wants(fields, 'destinations', *IMAGE_FIELDS):
+        obj['destinations'] = []
+        for x in tour_destinations:
+            dest = dict(destinations[x.destination_id])
+            dest['order'] = x.order
+            obj['destinations'].append(dest)
+
+        # Use the images from the first destination for the tour
+        if obj['destinations']:
+            first_dest = obj['destinations'][0]
+            for field_name in IMAGE_FIELDS:
+                if field_name in first_dest:
+                    obj[field_name] = first_dest[field_name]
+
+    return select_fields(obj, fields)
+
+
+def serialize_destinations(destinations, fields=None):
+    """Serialize a batch of destinations as JSON, with a constant number of queries.
+
+    :param destinations: Destination queryset or list of Destination objects
+    :param fields: Optional set of names of the properties to serialize; related objects and
+                   images only used for other properties are not loaded
+    :returns: List of dictionary representations of the destinations
+    """
+    destinations = list(destinations)
+    prefetch_related_objects(destinations, *get_prefetches(DESTINATION_PREFETCHES, fields))
+    images = destinations if wants(fields, *IMAGE_FIELDS) else []
+    if wants(fields, *EXTRA_IMAGE_FIELDS):
+        images = images + [extra for d in destinations for extra in d.extra_pictures]
+    prefetch_thumbnail_urls(images)
+    return [set_destination_properties(destination, fields) for destination in destinations]
+
+
+def serialize_destinations_by_id(destinations, fields=None):
+    """Serialize each of a batch of destinations once, even if some are repeated.
+
+    :param destinations: Iterable of Destination objects
+    :param fields: Optional set of names of the properties to serialize
+    :returns: Dictionary of destination ID to dictionary representation of the destination
+    """
+    unique = {destination.pk: destination for destination in destinations}
+    return dict(zip(unique.keys(), serialize_destinations(unique.values(), fields)))
+
+
+def serialize_events(events, fields=None):
+    """Serialize a batch of events as JSON, with a constant number of queries.
+
+    :param events: Event queryset or list of Event objects
+    :param fields: Optional set of names of the properties to serialize; related objects and
+                   images only used for other properties are not loaded
+    :returns: List of dictionary representations of the events
+    """
+    events = list(events)
+    prefetch_related_objects(events, *get_prefetches(EVENT_PREFETCHES, fields))
+    images = events if wants(fields, *IMAGE_FIELDS) else []
+    if wants(fields, *EXTRA_IMAGE_FIELDS):
+        images = images + [extra for event in events for extra in event.extra_pictures]
+    prefetch_thumbnail_urls(images)
+
+    destinations = {}
+    if wants(fields, 'destinations'):
+        destinations = serialize_destinations_by_id(x.destination for event in events
+                                                    for x in event.event_destinations.all())
+    return [set_event_properties(event, destinations, fields) for event in events]
+
+
+def serialize_tours(tours, fields=None):
+    """Serialize a batch of tours as JSON, with a constant number of queries.
+
+    :param tours: Tour queryset or list of Tour objects
+    :param fields: Optional set of names of the properties to serialize; destinations are only
+                   serialized if needed for the requested properties
+    :returns: List of dictionary representations of the tours
+    """
+    tours = list(tours)
+    prefetch_related_objects(tours, *get_prefetches(TOUR_PREFETCHES, fields))
+
+    destinations = {}
+    if wants(fields, 'destinations', *IMAGE_FIELDS):
+        # nested destinations are serialized in full, but if only the tour images (which are
+        # those of its first destination) are wanted, only images are needed
+        destination_fields = (None if wants(fields, 'destinations')
+                              else fields.intersection(IMAGE_FIELDS))
+        destinations = serialize_destinations_by_id((x.destination for tour in tours
+                                                     for x in tour.tour_destinations.all()),
+                                                    destination_fields)
+    return [set_tour_properties(tour, destinations, fields) for tour in tours]
@@ -0,0 +1,70 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from cac_tripplanner.content_version import bump_content_version
+from cac_tripplanner.publish_utils import published_changed
+
+from .models import (Activity,
+                     Destination,
+                     DestinationCategory,
+                     Event,
+                     EventDestination,
+                     ExtraDestinationPicture,
+                     ExtraEventPicture,
+                     Tour,
+                     TourDestination,
+                     update_explorable_destinations)
+from .thumbnails import store_thumbnail_urls, THUMBNAILS
+
+# Models whose changes can affect which destinations are explorable
+EXPLORABLE_SENDERS = (Destination, Event, EventDestination, Tour, TourDestination)
+
+# Other models serialized with destinations, events, or tours
+SERIALIZED_SENDERS = (Activity, DestinationCategory, ExtraDestinationPicture, ExtraEventPicture)
+
+# Many-to-many relations, which the admin saves after the object itself
+M2M_SENDERS = (Destination.categories.through,
+               Destination.activities.through,
+               Event.activities.through)
+
+
+def content_changed(sender, **kwargs):
+    """Update derived data when destinations, events, or tours are changed."""
+    if kwargs.get('raw'):
+        # loading fixtures
+        return
+    update_explorable_destinations()
+    bump_content_version()
+
+
+def serialized_content_changed(sender, **kwargs):
+    """Mark serialized documents out of date when something included in them is changed."""
+    if kwargs.get('raw'):
+        return
+    bump_content_version()
+
+
+def image_saved(sender, instance, **kwargs):
+    """Generate thumbnails when an object with images is saved, and store their URLs."""
+    if kwargs.get('raw'):
+        return
+    store_thumbnail_urls(instance)
+
+
+def relations_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_content_version()
+
+
+def connect_signals():
+    # store thumbnail URLs first, so they are there for documents serialized after the change
+    for sender in THUMBNAILS:
+        post_save.connect(image_saved, sender=sender)
+    for sender in EXPLORABLE_SENDERS:
+        post_save.connect(content_changed, sender=sender)
+        post_delete.connect(content_changed, sender=sender)
+        published_changed.connect(content_changed, sender=sender)
+    for sender in SERIALIZED_SENDERS:
+        post_save.connect(serialized_content_changed, sender=sender)
+        post_delete.connect(serialized_content_changed, sender=sender)
+    for sender in M2M_SENDERS:
+        m2m_changed.connect(relations_changed, sender=sender)
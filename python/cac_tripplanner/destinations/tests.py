@@ -1,13 +1,31 @@
 from datetime import timedelta
 import json
+from unittest import mock
 
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import Point, Polygon
 from django.core.files import File
 from django.urls import reverse
+from django.db import connection
 from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
-from destinations.models import Destination, Event, EventDestination, Tour, TourDestination
+from cac_tripplanner.content_version import get_content_version
+from destinations.autocomplete import AutocompleteIndex
+from destinations.models import (prefetch_first_destinations, shuffled_ids, Destination, Event,
+                                 EventDestination, ThumbnailURL, Tour, TourDestination)
+from destinations.pagination import encode_cursor
+from destinations.search import search_rows, union_search
+from destinations.serializers import (serialize_destinations,
+                                      serialize_tours,
+                                      set_destination_properties)
+from destinations.templatetags.destination_extras import (get_place_ids,
+                                                          get_tour_directions_permalink,
+                                                          has_activity)
+from destinations.thumbnails import image_to_url, prefetch_thumbnail_urls
+from destinations.tiles import get_tile
+from destinations.travelshed_index import get_travelshed_index
+from destinations.views import EVENT_DETAIL_PREFETCHES, TOUR_DETAIL_PREFETCHES
 
 
 class EventTests(TestCase):
@@ -192,6 +210,24 @@ class EventMultiDestinationTests(TestCase):
         self.assertEqual(self.event_2.event_destinations.first().order, 1)
         self.assertEqual(self.event_2.event_destinations.all()[1].order, 2)
 
+    def test_event_detail_prefetched(self):
+        """The first destination on event detail pages should come from the prefetched ones"""
+        event = (Event.objects.with_summaries().prefetch_related(*EVENT_DETAIL_PREFETCHES)
+                 .get(pk=self.event_1.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(event.first_destination, self.place_2)
+            self.assertEqual(json.loads(get_place_ids(event)), [self.place_2.pk, self.place_1.pk])
+
+    def test_event_summaries(self):
+        """Annotated first destinations of events should match those queried for each event"""
+        expected = [event.first_destination for event in Event.objects.order_by("pk")]
+        with self.assertNumQueries(2):
+            events = list(Event.objects.with_summaries().order_by("pk"))
+            prefetch_first_destinations(events)
+        with self.assertNumQueries(0):
+            self.assertEqual([event.first_destination for event in events], expected)
+        self.assertEqual(events[0].first_destination, self.place_2)
+
     def test_event_search(self):
         """Test that events show in search results"""
         url = reverse("api_destinations_search")
@@ -248,6 +284,18 @@ class DestinationTests(TestCase):
     def test_destination_manager_published(self):
         self.assertEqual(Destination.objects.published().count(), 2)
 
+    def test_destination_shuffled(self):
+        """Destinations with the same priority should keep one shuffled order across queries"""
+        shuffled = list(Destination.objects.published().shuffled())
+        self.assertEqual(shuffled, list(Destination.objects.published().shuffled()))
+        order = shuffled_ids(Destination)
+        self.assertEqual([d.pk for d in shuffled],
+                         sorted([self.place_1.pk, self.place_2.pk], key=order.index))
+        # the order is sent as one parameter, rather than a constant per ID in the SQL
+        sql, params = Destination.objects.shuffled().query.sql_with_params()
+        self.assertNotIn("ARRAY", sql)
+        self.assertIn("{" + ",".join(str(pk) for pk in order) + "}", params)
+
     def test_place_detail_view(self):
         """Test that place detail view works"""
         url = reverse("place-detail", kwargs={"pk": self.place_1.pk})
@@ -267,6 +315,218 @@ class DestinationTests(TestCase):
         json_response = json.loads(response.content)
         self.assertEqual(len(json_response["destinations"]), 2)
 
+    def test_destination_search_ranked(self):
+        """Text search should return the closest match first"""
+        url = reverse("api_destinations_search") + "?text=place_two"
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(json_response["destinations"][0]["id"], self.place_2.pk)
+
+    def test_destination_search_only_distance(self):
+        """Requesting only the distance should give valid JSON with just that property"""
+        url = reverse("api_destinations_search") + "?lat=0&lon=0&fields=distance"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["destinations"], [{"distance": 0}, {"distance": 0}])
+
+    def test_destination_search_nearest_in_meters(self):
+        """Nearest destinations should be ordered by distance in meters, rather than in degrees"""
+        # at this latitude, a degree of longitude is about 0.77 times the length of one of latitude
+        place_east = Destination.objects.create(name="place_east", published=True,
+                                                description="East", point=Point(-74.99, 40))
+        place_north = Destination.objects.create(name="place_north", published=True,
+                                                 description="North", point=Point(-75, 40.008))
+        url = reverse("api_destinations_search") + "?lat=40&lon=-75&limit=2"
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual([d["id"] for d in json_response["destinations"]],
+                         [place_east.pk, place_north.pk])
+        self.assertAlmostEqual(json_response["destinations"][0]["distance"], 852, delta=5)
+        self.assertAlmostEqual(json_response["destinations"][1]["distance"], 889, delta=5)
+
+    def test_destination_search_negative_priority(self):
+        """Text search should rank objects with negative priorities, as if their priority were 0"""
+        self.place_2.priority = -1
+        self.place_2.save()
+        url = reverse("api_destinations_search") + "?text=place"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["destinations"][0]["id"], self.place_2.pk)
+
+    def test_destination_search_cursor(self):
+        """Cursor pagination should page through nearby destinations, with ties broken by ID"""
+        url = reverse("api_destinations_search") + "?lat=0&lon=0&limit=1&cursor="
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual([d["id"] for d in json_response["destinations"]], [self.place_1.pk])
+        self.assertEqual(json_response["destinations"][0]["distance"], 0)
+        self.assertIsNotNone(json_response["next"])
+
+        url = (reverse("api_destinations_search") + "?lat=0&lon=0&limit=1&cursor=" +
+               json_response["next"])
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual([d["id"] for d in json_response["destinations"]], [self.place_2.pk])
+        self.assertIsNone(json_response["next"])
+
+        url = reverse("api_destinations_search") + "?lat=0&lon=0&cursor=bad"
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+        # cursors that decode, but not to positions in the search ordering
+        for positions in ({"destinations": 1}, {"destinations": [[0], {}]},
+                          {"destinations": ["far", "away"]}, {"events": [None, "2020"]}):
+            url = (reverse("api_destinations_search") + "?lat=0&lon=0&cursor=" +
+                   encode_cursor(positions))
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_union_search_ordered(self):
+        """Combined search rows should be in each kind's ordering, whatever order they come in"""
+        rows = union_search({"destinations": ("id",), "tours": ("id",)},
+                            destinations=search_rows(Destination.objects.order_by("-id"),
+                                                     "destinations", ("id",)),
+                            tours=search_rows(Tour.objects.none(), "tours", ("id",)))
+        self.assertEqual([row[1] for row in rows["destinations"]],
+                         sorted(Destination.objects.values_list("id", flat=True)))
+        self.assertEqual(rows["tours"], [])
+
+    def test_destination_search_one_query(self):
+        """Searching with cached documents should find all three kinds of result in one query"""
+        url = reverse("api_destinations_search") + "?text="
+        expected = json.loads(self.client.get(url).content)
+
+        with CaptureQueriesContext(connection) as queries:
+            json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(json_response, expected)
+        search_queries = [query["sql"] for query in queries.captured_queries
+                          if "cac_tripplanner_cache" not in query["sql"] and
+                          "cac_tripplanner_stamps" not in query["sql"]]
+        self.assertEqual(len(search_queries), 1)
+        self.assertIn("UNION ALL", search_queries[0])
+
+    def test_viewport_destinations(self):
+        """Destinations in the viewport should be clustered at low zooms, and listed at high"""
+        url = reverse("api_destinations_viewport") + "?bbox=-1,-1,1,1&zoom=5"
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(json_response["destinations"], [])
+        self.assertEqual([cluster["count"] for cluster in json_response["clusters"]], [2])
+
+        url = reverse("api_destinations_viewport") + "?bbox=-1,-1,1,1&zoom=15"
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(sorted(d["id"] for d in json_response["destinations"]),
+                         [self.place_1.pk, self.place_2.pk])
+        self.assertEqual(json_response["clusters"], [])
+
+        url = reverse("api_destinations_viewport") + "?bbox=1,1,2,2&zoom=15"
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(json_response["destinations"], [])
+
+        url = reverse("api_destinations_viewport") + "?bbox=1,1,0,0&zoom=15"
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+        with self.settings(SEARCH_MAX_PAGE_SIZE=1):
+            url = reverse("api_destinations_viewport") + "?bbox=-1,-1,1,1&zoom=15"
+            json_response = json.loads(self.client.get(url).content)
+            self.assertEqual([d["id"] for d in json_response["destinations"]],
+                             [min(self.place_1.pk, self.place_2.pk)])
+            self.assertTrue(json_response["truncated"])
+
+        for zoom in ("-1", "23", "2000"):
+            url = reverse("api_destinations_viewport") + "?bbox=-1,-1,1,1&zoom=" + zoom
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_destination_tiles(self):
+        """Vector tiles should include published destinations within them"""
+        response = self.client.get(reverse("destination_tile", kwargs={"z": 0, "x": 0, "y": 0}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/vnd.mapbox-vector-tile")
+        self.assertIn(b"place_one", response.content)
+        self.assertNotIn(b"place_three", response.content)
+
+        response = self.client.get(reverse("destination_tile", kwargs={"z": 10, "x": 0, "y": 0}))
+        self.assertEqual(response.content, b"")
+
+        response = self.client.get(reverse("destination_tile", kwargs={"z": 1, "x": 2, "y": 0}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_tiles_remade_each_content_period(self):
+        """Cached tiles should not outlast the content period, so ended events drop out"""
+        with mock.patch("destinations.tiles.make_tile", return_value=b"tile") as make_tile:
+            with mock.patch("destinations.tiles.get_content_period", return_value=1):
+                get_tile(0, 0, 0)
+                get_tile(0, 0, 0)
+            self.assertEqual(make_tile.call_count, 1)
+            with mock.patch("destinations.tiles.get_content_period", return_value=2):
+                get_tile(0, 0, 0)
+            self.assertEqual(make_tile.call_count, 2)
+
+    def test_home_place_cards(self):
+        """Home page should list published destinations from cards cached until content changes"""
+        response = self.client.get(reverse("home"))
+        self.assertContains(response, "place_one")
+        self.assertContains(response, "place_two")
+        self.assertNotContains(response, "place_three")
+
+        self.place_1.name = "place_renamed"
+        self.place_1.save()
+        response = self.client.get(reverse("home"))
+        self.assertContains(response, "place_renamed")
+        self.assertNotContains(response, "place_one")
+
+    def test_thumbnail_urls_stored(self):
+        """Thumbnail URLs should be stored on save, and used in search results"""
+        self.place_1.image_raw = "default_media/square/BartramsGarden.jpg"
+        self.place_1.image = ""
+        self.place_1.save()
+        stored = ThumbnailURL.objects.get(source=self.place_1.image_raw.name, size="310x155",
+                                          box="")
+        stored.url = "/media/stored.jpg"
+        stored.save()
+
+        url = reverse("api_destinations_search") + "?text=place_one"
+        response = self.client.get(url)
+        json_response = json.loads(response.content)
+        self.assertEqual(json_response["destinations"][0]["image"], "/media/stored.jpg")
+
+    def test_thumbnail_urls_by_crop_box(self):
+        """Objects sharing an image but cropping it differently should each keep their own URL"""
+        image = "default_media/square/BartramsGarden.jpg"
+        self.place_1.image_raw = image
+        self.place_1.image = ""
+        self.place_1.save()
+        self.place_2.image_raw = image
+        self.place_2.image = "0,0,100,50"
+        self.place_2.save()
+        self.assertEqual(ThumbnailURL.objects.filter(source=image, size="310x155").count(), 2)
+
+        places = list(Destination.objects.filter(pk__in=[self.place_1.pk, self.place_2.pk]))
+        with self.assertNumQueries(1):
+            prefetch_thumbnail_urls(places)
+        self.assertTrue(all("image" in place.thumbnail_urls for place in places))
+
+    def test_missing_thumbnail_url_not_generated(self):
+        """Without a stored thumbnail URL, the uncropped image should be used, not generated"""
+        self.place_1.image_raw = "default_media/square/BartramsGarden.jpg"
+        self.place_1.image = ""
+        self.place_1.save()
+        ThumbnailURL.objects.filter(source=self.place_1.image_raw.name).delete()
+
+        place = Destination.objects.get(pk=self.place_1.pk)
+        self.assertEqual(image_to_url(place, "image"), place.image_raw.url)
+        self.assertFalse(ThumbnailURL.objects.filter(source=place.image_raw.name).exists())
+
+    def test_search_documents_invalidated(self):
+        """Serialized documents should be reused until content is saved"""
+        url = reverse("api_destinations_search") + "?text=place_one"
+        self.client.get(url)
+
+        # updates that skip signals are not seen
+        Destination.objects.filter(pk=self.place_1.pk).update(description="Updated")
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(json_response["destinations"][0]["description"], "Sample place for tests")
+
+        self.place_1.refresh_from_db()
+        self.place_1.save()
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(json_response["destinations"][0]["description"], "Updated")
+
 
 class TourTests(TestCase):
     def setUp(self):
@@ -351,6 +611,96 @@ class TourTests(TestCase):
         json_response = json.loads(response.content)
         self.assertEqual(len(json_response["tours"]), 1)
 
+    def test_search_summary_view(self):
+        """Summary view should only return the summary properties"""
+        url = reverse("api_destinations_search") + "?text=&view=summary"
+        json_response = json.loads(self.client.get(url).content)
+        summary = {"id", "name", "is_event", "is_tour", "point"}
+        self.assertEqual(set(json_response["destinations"][0].keys()), summary)
+        self.assertEqual(set(json_response["tours"][0].keys()), summary)
+
+        url = reverse("api_destinations_search") + "?text=&fields=id,image"
+        json_response = json.loads(self.client.get(url).content)
+        self.assertEqual(set(json_response["tours"][0].keys()), {"id", "image"})
+        # tour image is that of its first destination
+        self.assertEqual(json_response["tours"][0]["image"],
+                         serialize_destinations([self.place_2])[0]["image"])
+
+        url = reverse("api_destinations_search") + "?text=&view=compact"
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_autocomplete(self):
+        """Autocomplete should suggest published places and tours by any word of their name"""
+        index = AutocompleteIndex.build(get_content_version())
+        suggestions = index.suggest("ON", 10)
+        self.assertEqual([(s.type, s.id) for s in suggestions],
+                         [("destination", self.place_1.pk), ("tour", self.tour_1.pk)])
+        self.assertEqual(index.suggest("tour_o", 10)[0].as_dict(),
+                         {"id": self.tour_1.pk, "type": "tour", "name": "tour_one",
+                          "point": {"type": "Point", "coordinates": [0.0, 0.0]}})
+        self.assertEqual(index.suggest("two", 10), [])
+
+    def test_tour_destinations_explorable(self):
+        """Unpublished destinations in a published tour should be explorable"""
+        self.place_2.refresh_from_db()
+        self.assertTrue(self.place_2.explorable)
+
+        self.tour_1.published = False
+        self.tour_1.save()
+        self.place_1.refresh_from_db()
+        self.place_2.refresh_from_db()
+        # still published itself
+        self.assertTrue(self.place_1.explorable)
+        self.assertFalse(self.place_2.explorable)
+
+    def test_serialize_destinations(self):
+        """Batch serialization should match serializing each destination on its own"""
+        destinations = Destination.objects.order_by("pk")
+        serialized = serialize_destinations(destinations)
+        self.assertEqual(serialized, [set_destination_properties(d) for d in destinations])
+        # only published tours are listed
+        self.assertEqual(serialized[0]["related_tours"],
+                         [{"id": self.tour_1.pk, "name": "tour_one"}])
+
+    def test_serialize_destinations_queries(self):
+        """Serializing destinations should take the same number of queries however many"""
+        # the destinations, then their categories, activities, extra pictures, and published tours
+        with self.assertNumQueries(5):
+            serialize_destinations(Destination.objects.filter(pk=self.place_1.pk))
+        with self.assertNumQueries(5):
+            serialize_destinations(Destination.objects.order_by("pk"))
+
+    def test_serialize_tours_queries(self):
+        """Serializing tours should take the same number of queries however many there are"""
+        # the tours, their tour destinations, then the 4 related objects of their destinations
+        with self.assertNumQueries(6):
+            serialize_tours(Tour.objects.filter(pk=self.tour_1.pk))
+        with self.assertNumQueries(6):
+            tours = serialize_tours(Tour.objects.order_by("pk"))
+        self.assertEqual([d["id"] for d in tours[0]["destinations"]],
+                         [self.place_2.pk, self.place_1.pk])
+        self.assertEqual(tours[0]["image"], tours[0]["destinations"][0]["image"])
+
+    def test_tour_detail_prefetched(self):
+        """Template tags on tour detail pages should use the prefetched destinations"""
+        tour = Tour.objects.prefetch_related(*TOUR_DETAIL_PREFETCHES).get(pk=self.tour_1.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(has_activity(tour, "cycling"))
+            self.assertEqual(json.loads(get_place_ids(tour)), [self.place_2.pk, self.place_1.pk])
+            self.assertIn("destinationText=tour_one", get_tour_directions_permalink(tour))
+            self.assertEqual(tour.first_destination, self.place_2)
+
+    def test_tour_summaries(self):
+        """Annotated tour properties should match those queried for each tour"""
+        expected = [(tour.accessible, tour.watershed_alliance, tour.first_destination)
+                    for tour in Tour.objects.order_by("pk")]
+        tours = list(Tour.objects.with_summaries().order_by("pk"))
+        prefetch_first_destinations(tours)
+        with self.assertNumQueries(0):
+            self.assertEqual([(tour.accessible, tour.watershed_alliance, tour.first_destination)
+                              for tour in tours], expected)
+        self.assertEqual(tours[0].first_destination, self.place_2)
+
     def test_tour_destination_order(self):
         self.assertEqual(self.tour_1.tour_destinations.count(), 2)
         self.assertEqual(self.tour_2.tour_destinations.count(), 2)
@@ -364,3 +714,45 @@ class TourTests(TestCase):
 
         self.assertEqual(self.tour_2.tour_destinations.first().order, 1)
         self.assertEqual(self.tour_2.tour_destinations.all()[1].order, 2)
+
+
+class TravelshedIndexTests(TestCase):
+    def setUp(self):
+        # Clear DB of objects created by migrations
+        Destination.objects.all().delete()
+
+        with open("default_media/square/BartramsGarden.jpg") as image_file:
+            test_image = File(image_file)
+
+            common_args = dict(
+                description="Sample place for tests", image=test_image, wide_image=test_image
+            )
+
+            self.near = Destination.objects.create(
+                name="near", published=True, point=Point(0.1, 0.1), **common_args
+            )
+            self.far = Destination.objects.create(
+                name="far", published=True, priority=1, point=Point(0.9, 0.9), **common_args
+            )
+            self.outside = Destination.objects.create(
+                name="outside", published=True, point=Point(2, 2), **common_args
+            )
+            self.unpublished = Destination.objects.create(
+                name="unpublished", published=False, point=Point(0.5, 0.5), **common_args
+            )
+
+        self.travelshed = Polygon(((0, 0), (0, 1), (1, 1), (1, 0), (0, 0)), srid=4326)
+
+    def test_match(self):
+        index = get_travelshed_index()
+        # ordered by priority without an origin
+        self.assertEqual(index.match(self.travelshed), [self.far.pk, self.near.pk])
+        # ordered by distance from the origin
+        self.assertEqual(index.match(self.travelshed, origin=Point(0, 0, srid=4326)),
+                         [self.near.pk, self.far.pk])
+
+    def test_rebuilt_on_change(self):
+        self.assertNotIn(self.unpublished.pk, get_travelshed_index().match(self.travelshed))
+        self.unpublished.published = True
+        self.unpublished.save()
+        self.assertIn(self.unpublished.pk, get_travelshed_index().match(self.travelshed))
@@ -0,0 +1,144 @@
+import logging
+
+from easy_thumbnails.exceptions import InvalidImageFormatError
+from image_cropping.utils import get_backend
+
+from cms.models import Article, ARTICLE_NARROW_IMAGE_DIMENSIONS, ARTICLE_WIDE_IMAGE_DIMENSIONS
+
+from .models import (Destination,
+                     Event,
+                     ExtraDestinationPicture,
+                     ExtraEventPicture,
+                     ThumbnailURL,
+                     NARROW_IMAGE_DIMENSIONS,
+                     WIDE_IMAGE_DIMENSIONS)
+
+logger = logging.getLogger(__name__)
+
+ATTRACTION_THUMBNAILS = (
+    ('image', NARROW_IMAGE_DIMENSIONS, 'image_raw'),
+    ('wide_image', WIDE_IMAGE_DIMENSIONS, 'wide_image_raw'),
+)
+EXTRA_IMAGE_THUMBNAILS = (
+    ('image', NARROW_IMAGE_DIMENSIONS, 'image_raw'),
+    ('wide_image', WIDE_IMAGE_DIMENSIONS, 'image_raw'),
+)
+
+# Cropped thumbnails served by the API, as (crop box field, size, raw image field), by model
+THUMBNAILS = {
+    Destination: ATTRACTION_THUMBNAILS,
+    Event: ATTRACTION_THUMBNAILS,
+    ExtraDestinationPicture: EXTRA_IMAGE_THUMBNAILS,
+    ExtraEventPicture: EXTRA_IMAGE_THUMBNAILS,
+    Article: (
+        ('wide_image', ARTICLE_WIDE_IMAGE_DIMENSIONS, 'wide_image_raw'),
+        ('narrow_image', ARTICLE_NARROW_IMAGE_DIMENSIONS, 'narrow_image_raw'),
+    ),
+}
+
+
+def size_string(size):
+    return 'x'.join([str(x) for x in size])
+
+
+def get_thumbnail_spec(obj, field_name):
+    """Returns the (crop box field, size, raw image field) of a thumbnail of an object."""
+    for spec in THUMBNAILS[obj._meta.concrete_model]:
+        if spec[0] == field_name:
+            return spec
+    raise KeyError('No thumbnail {field} for {model}'.format(
+        field=field_name, model=type(obj).__name__))
+
+
+def generate_thumbnail_url(obj, field_name, size, raw_field_name):
+    """Generate a cropped thumbnail with the thumbnail backend, and return its URL.
+
+    May read from or write to storage, so this is only done when images are saved.
+
+    :param obj: Model object with the image
+    :param field_name: Name of the crop box field
+    :param size: Tuple of (width, height) of the thumbnail
+    :param raw_field_name: Name of the image field the crop box applies to
+    :returns: URL of the image, or an empty string if there is no image
+    """
+    image = getattr(obj, raw_field_name)
+    if not image:
+        return ''
+    options = {
+        'size': size,
+        'crop': True,
+        'detail': True
+    }
+    box = getattr(obj, field_name)
+    if box:
+        options['box'] = box
+
+    try:
+        return get_backend().get_thumbnail_url(image, options)
+    except InvalidImageFormatError:
+        return ''
+
+
+def store_thumbnail_urls(obj):
+    """Generate the thumbnails for an object, and store their URLs.
+
+    :param obj: Model object in `THUMBNAILS`
+    """
+    for field_name, size, raw_field_name in THUMBNAILS[obj._meta.concrete_model]:
+        image = getattr(obj, raw_field_name)
+        if not image:
+            continue
+        url = generate_thumbnail_url(obj, field_name, size, raw_field_name)
+        ThumbnailURL.objects.update_or_create(source=image.name, size=size_string(size),
+                                              box=getattr(obj, field_name) or '',
+                                              defaults={'url': url})
+
+
+def prefetch_thumbnail_urls(objects):
+    """Load stored thumbnail URLs for a batch of objects, in a single query.
+
+    Sets `thumbnail_urls` on each object to a dictionary of crop box field name to URL, for those
+    thumbnails with a stored URL for the current crop box.
+
+    :param objects: Model objects, of any models in `THUMBNAILS`
+    """
+    wanted = {}
+    for obj in objects:
+        obj.thumbnail_urls = {}
+        for field_name, size, raw_field_name in THUMBNAILS[obj._meta.concrete_model]:
+            image = getattr(obj, raw_field_name)
+            if image:
+                key = (image.name, size_string(size), getattr(obj, field_name) or '')
+                wanted.setdefault(key, []).append((obj, field_name))
+    if not wanted:
+        return
+
+    sources = {source for source, size, box in wanted}
+    for stored in ThumbnailURL.objects.filter(source__in=sources):
+        for obj, field_name in wanted.get((stored.source, stored.size, stored.box), []):
+            obj.thumbnail_urls[field_name] = stored.url
+
+
+def image_to_url(obj, field_name):
+    """Returns the URL of a cropped thumbnail, from the stored thumbnail URLs.
+
+    If the URL has not been stored (i.e. the object was saved outside the admin, and the
+    `backfill_thumbnail_urls` command has not been run since), the uncropped image's URL is
+    returned instead, as generating the thumbnail would hold up the request.
+
+    :param obj: Model object with the image
+    :param field_name: Name of the crop box field of the thumbnail
+    :returns: URL of the image, or an empty string if there is no image
+    """
+    if not hasattr(obj, 'thumbnail_urls'):
+        prefetch_thumbnail_urls([obj])
+    if field_name in obj.thumbnail_urls:
+        return obj.thumbnail_urls[field_name]
+
+    field_name, size, raw_field_name = get_thumbnail_spec(obj, field_name)
+    image = getattr(obj, raw_field_name)
+    if not image:
+        return ''
+    logger.warning('No stored %s thumbnail URL for %s %s; using the uncropped image',
+                   field_name, type(obj).__name__, obj.pk)
+    return image.url
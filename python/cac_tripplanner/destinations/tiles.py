@@ -0,0 +1,143 @@
+from math import atan, degrees, pi, sinh
+
+from django.core.cache import caches
+from django.db import connection
+from django.utils.timezone import now
+
+from cac_tripplanner.content_version import (CONTENT_ETAG_PERIOD,
+                                             get_content_period,
+                                             get_content_version)
+
+# Largest zoom level tiles are made for
+TILE_MAX_ZOOM = 22
+
+# Size of the tile coordinate space, and of the buffer around tiles within which features are
+# included, so markers near tile edges are not cut off
+TILE_EXTENT = 4096
+TILE_BUFFER = 256
+
+# Tiles are keyed on the content version, so are replaced as soon as any content changes, and on
+# the content period, so events that have ended drop out of them as they do from listings.
+# Tiles from earlier periods are never used again, so aren't kept past their period.
+TILE_TIMEOUT = CONTENT_ETAG_PERIOD
+
+TILE_LAYER = 'destinations'
+
+# Published destinations, current events, and published tours (events and tours located at their
+# first destination), each with its type and comma-separated category names, clipped to a tile
+TILE_SQL = """
+WITH features AS (
+    SELECT d.id, d.name, 'destination' AS type,
+           COALESCE((SELECT string_agg(c.name, ',' ORDER BY c.name)
+                     FROM destinations_destination_categories dc
+                     JOIN destinations_destinationcategory c ON c.id = dc.destinationcategory_id
+                     WHERE dc.destination_id = d.id), '') AS categories,
+           d.point
+    FROM destinations_destination d
+    WHERE d.published AND d.point && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s, %(north)s,
+                                                     4326)
+    UNION ALL
+    SELECT e.id, e.name, 'event' AS type, '' AS categories, first_destination.point
+    FROM destinations_event e
+    CROSS JOIN LATERAL (
+        SELECT d.point
+        FROM destinations_eventdestination ed
+        JOIN destinations_destination d ON d.id = ed.destination_id
+        WHERE ed.related_event_id = e.id
+        ORDER BY ed."order"
+        LIMIT 1) first_destination
+    WHERE e.published AND e.end_date >= %(now)s
+          AND first_destination.point && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s,
+                                                         %(north)s, 4326)
+    UNION ALL
+    SELECT t.id, t.name, 'tour' AS type, '' AS categories, first_destination.point
+    FROM destinations_tour t
+    CROSS JOIN LATERAL (
+        SELECT d.point
+        FROM destinations_tourdestination td
+        JOIN destinations_destination d ON d.id = td.destination_id
+        WHERE td.related_tour_id = t.id
+        ORDER BY td."order"
+        LIMIT 1) first_destination
+    WHERE t.published
+          AND first_destination.point && ST_MakeEnvelope(%(west)s, %(south)s, %(east)s,
+                                                         %(north)s, 4326)
+), tile AS (
+    SELECT id, name, type, categories,
+           ST_AsMVTGeom(ST_Transform(point, 3857), ST_TileEnvelope(%(z)s, %(x)s, %(y)s),
+                        %(extent)s, %(buffer)s) AS geom
+    FROM features
+)
+SELECT ST_AsMVT(tile, %(layer)s, %(extent)s, 'geom') FROM tile
+"""
+
+
+def tile_bounds(z, x, y, buffer=0):
+    """Longitude and latitude bounds of a web map tile.
+
+    :param z: Zoom level
+    :param x: Column of the tile, from the west
+    :param y: Row of the tile, from the north
+    :param buffer: Fraction of the tile's size to extend the bounds by on each side
+    :returns: Tuple of west, south, east, and north bounds, in degrees
+    """
+    tiles = 2 ** z
+
+    def lon(column):
+        return column / tiles * 360.0 - 180.0
+
+    def lat(row):
+        row = min(max(row, 0), tiles)
+        return degrees(atan(sinh(pi * (1 - 2 * row / tiles))))
+
+    return (lon(x - buffer), lat(y + 1 + buffer), lon(x + 1 + buffer), lat(y - buffer))
+
+
+def parse_zoom(value):
+    """Parse a web map zoom level.
+
+    :param value: Zoom level, as a string
+    :returns: Zoom level, as an integer
+    :raises ValueError: if the zoom level is not an integer from 0 to TILE_MAX_ZOOM
+    """
+    zoom = int(value)
+    if not 0 <= zoom <= TILE_MAX_ZOOM:
+        raise ValueError('zoom must be from 0 to {max_zoom}'.format(max_zoom=TILE_MAX_ZOOM))
+    return zoom
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_key(z, x, y, version, period):
+    return 'tile:{z}:{x}:{y}:{version}:{period}'.format(z=z, x=x, y=y, version=version,
+                                                        period=period)
+
+
+def make_tile(z, x, y):
+    """Make a Mapbox vector tile of the destinations, events, and tours within a web map tile."""
+    west, south, east, north = tile_bounds(z, x, y, buffer=TILE_BUFFER / TILE_EXTENT)
+    with connection.cursor() as cursor:
+        cursor.execute(TILE_SQL, {'z': z, 'x': x, 'y': y,
+                                  'west': west, 'south': south, 'east': east, 'north': north,
+                                  'now': now(), 'extent': TILE_EXTENT, 'buffer': TILE_BUFFER,
+                                  'layer': TILE_LAYER})
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile is not None else b''
+
+
+def get_tile(z, x, y):
+    """Get a vector tile from the content cache for the current content version, or make it.
+
+    Events that have ended stay in cached tiles until the end of the current content period.
+
+    :returns: Tile, as bytes
+    """
+    cache = caches['content']
+    key = tile_key(z, x, y, get_content_version(), get_content_period())
+    tile = cache.get(key)
+    if tile is None:
+        tile = make_tile(z, x, y)
+        cache.set(key, tile, timeout=TILE_TIMEOUT)
+    return tile
@@ -0,0 +1,107 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+import logging
+from math import asin, cos, radians, sin, sqrt
+import threading
+
+from django.contrib.gis.geos import Point
+
+from cac_tripplanner.content_version import get_content_version
+
+from .models import Destination
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def haversine_distance(lon1, lat1, lon2, lat2):
+    """Great-circle distance in meters between two WGS 84 coordinates."""
+    lon1, lat1, lon2, lat2 = map(radians, (lon1, lat1, lon2, lat2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * asin(sqrt(a))
+
+
+class IndexedDestination(object):
+    """Location and filter properties of an explorable destination."""
+
+    __slots__ = ('pk', 'x', 'y', 'priority', 'categories')
+
+    def __init__(self, pk, x, y, priority, categories):
+        self.pk = pk
+        self.x = x
+        self.y = y
+        self.priority = priority
+        self.categories = categories
+
+
+class TravelshedIndex(object):
+    """In-memory spatial index of explorable destinations, for matching against isochrones.
+
+    Destinations are sorted by longitude, so that only those within the longitude range of an
+    isochrone's extent are checked against its latitude range, and then against the prepared
+    isochrone geometry.
+    """
+
+    def __init__(self, version, destinations):
+        self.version = version
+        self.destinations = sorted(destinations, key=lambda d: d.x)
+        self.xs = [d.x for d in self.destinations]
+
+    @classmethod
+    def build(cls, version):
+        """Load explorable destinations from the database."""
+        categories = defaultdict(set)
+        for pk, category in (Destination.objects.filter(explorable=True,
+                                                        categories__isnull=False)
+                             .values_list('pk', 'categories__name')):
+            categories[pk].add(category)
+        destinations = [IndexedDestination(pk, point.x, point.y, priority, categories[pk])
+                        for pk, point, priority in (Destination.objects.filter(explorable=True)
+                                                    .values_list('pk', 'point', 'priority'))]
+        logger.debug('Built travelshed index of %d destinations', len(destinations))
+        return cls(version, destinations)
+
+    def match(self, travelshed, origin=None, categories=None):
+        """Find indexed destinations within a travelshed.
+
+        :param travelshed: GEOS geometry in SRID 4326
+        :param origin: Optional GEOS Point to order results by distance from
+        :param categories: Optional list of category names; if set, matches must be in at least one
+        :returns: List of matched destination IDs, ordered by distance from the origin (if given),
+                  then by priority
+        """
+        xmin, ymin, xmax, ymax = travelshed.extent
+        prepared = travelshed.prepared
+        categories = set(categories) if categories else None
+
+        matched = []
+        for destination in self.destinations[bisect_left(self.xs, xmin):
+                                             bisect_right(self.xs, xmax)]:
+            if not ymin <= destination.y <= ymax:
+                continue
+            if categories and not categories & destination.categories:
+                continue
+            if prepared.contains(Point(destination.x, destination.y, srid=4326)):
+                matched.append(destination)
+
+        if origin:
+            matched.sort(key=lambda d: (haversine_distance(origin.x, origin.y, d.x, d.y),
+                                        d.priority))
+        else:
+            matched.sort(key=lambda d: d.priority)
+        return [d.pk for d in matched]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_travelshed_index():
+    """Returns the travelshed index for this process, rebuilding it if content has changed."""
+    global _index
+    version = get_content_version()
+    with _index_lock:
+        if _index is None or _index.version != version:
+            _index = TravelshedIndex.build(version)
+        return _index
@@ -1,32 +1,64 @@
+from functools import partial
 import json
 import logging
-import requests
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.gis.db.models.functions import Distance
-from django.contrib.gis.geos import GEOSGeometry, Point
+from django.contrib.gis.geos import Point
 from django.core.exceptions import MultipleObjectsReturned
 from django.db import transaction
-from django.db.models import Q
-from django.forms.models import model_to_dict
-from django.http import JsonResponse
+from django.db.models import F, Prefetch
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, render
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
-from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.views.generic import View
 
-from easy_thumbnails.exceptions import InvalidImageFormatError
-from image_cropping.utils import get_backend
-
-from .models import (Destination,
+from cac_tripplanner.content_version import content_etag
+from cac_tripplanner.otp_client import get_otp_client, OTPUnavailableError
+from .autocomplete import get_autocomplete_index
+from .clusters import cluster_destinations, parse_bbox
+from .documents import (add_properties,
+                        destination_documents,
+                        destination_documents_by_id,
+                        encode_object,
+                        event_documents_by_id,
+                        tour_documents_by_id)
+from .home import get_place_cards, home_places
+from .isochrones import (cache_isochrone,
+                         get_cached_isochrone,
+                         isochrone_bands,
+                         isochrone_cache_key,
+                         isochrone_flights,
+                         isochrone_simplify_tolerance,
+                         parse_cutoffs,
+                         simplify_isochrone,
+                         snap_isochrone_params,
+                         ISOCHRONE_ENCODINGS)
+from .models import (prefetch_first_destinations,
+                     Destination,
                      Event,
-                     ExtraDestinationPicture,
-                     ExtraEventPicture,
+                     EventDestination,
                      Tour,
-                     UserFlag,
-                     NARROW_IMAGE_DIMENSIONS,
-                     WIDE_IMAGE_DIMENSIONS)
+                     TourDestination,
+                     UserFlag)
+from .pagination import (decode_cursor,
+                         encode_cursor,
+                         page_queryset,
+                         split_page,
+                         InvalidCursorError)
+from .search import (destination_text_search,
+                     nearest_distance,
+                     search_rows,
+                     text_search,
+                     union_search,
+                     ORDERING_COLUMNS,
+                     SEARCH_ORDERING)
+from .serializers import EVENT_CATEGORY, SUMMARY_FIELDS, TOUR_CATEGORY
+from .tiles import get_tile, parse_zoom, valid_tile
+from .travelshed_index import get_travelshed_index
 from cms.models import Article
 
 logger = logging.getLogger(__name__)
@@ -39,9 +71,6 @@ DEFAULT_CONTEXT = {
     'routing_url': settings.ROUTING_URL
 }
 
-EVENT_CATEGORY = 'Events'
-TOUR_CATEGORY = 'Tours'
-
 
 def base_view(request, page, context):
     """
@@ -60,19 +89,11 @@ def base_view(request, page, context):
 def home(request):
     # Load one random article
     article = Article.objects.random()
-    # Show all destinations, events, and tours
-    destinations = list(Destination.objects.published().order_by('priority'))
-    # Return one tour and one event each, unless there aren't any of one kind,
-    # then return two of the other.
-    events = list(Event.objects.current().order_by('priority', 'start_date'))[:2]
-    tours = list(Tour.objects.published().order_by('priority'))[:2]
-    if len(events) > 0 and len(tours) > 0:
-        events = events[0:1]
-        tours = tours[0:1]
+    # Show all destinations, events, and tours, from cards rendered once per content version
     context = {
         'tab': 'home',
         'article': article,
-        'destinations': events + tours + destinations
+        'place_cards': get_place_cards(home_places())
     }
     if request.GET.get('destination') is not None:
         # If there's a destination in the URL, go right to directions
@@ -140,220 +161,108 @@ def service_worker(request):
                   content_type='application/javascript')
 
 
+# Related objects used by the detail page templates and their template tags, loaded up front
+# rather than queried by each tag
+PLACE_DETAIL_PREFETCHES = ('activities', 'categories', 'extradestinationpicture_set')
+EVENT_DETAIL_PREFETCHES = (
+    'activities',
+    'extraeventpicture_set',
+    Prefetch('event_destinations',
+             queryset=EventDestination.objects.select_related('destination')),
+)
+TOUR_DETAIL_PREFETCHES = (
+    Prefetch('tour_destinations',
+             queryset=(TourDestination.objects.select_related('destination')
+                                              .prefetch_related('destination__activities'))),
+)
+
+
 def place_detail(request, pk):
-    destination = get_object_or_404(Destination.objects.all(), pk=pk)
-    more_destinations = Destination.objects.published().exclude(pk=destination.pk)[:3]
+    destination = get_object_or_404(Destination.objects.prefetch_related(*PLACE_DETAIL_PREFETCHES),
+                                    pk=pk)
+    more_destinations = Destination.objects.published().exclude(pk=destination.pk).shuffled()[:3]
     context = dict(tab='explore', destination=destination, more_destinations=more_destinations,
                    **DEFAULT_CONTEXT)
     return base_view(request, 'place-detail.html', context=context)
 
 
 def event_detail(request, pk):
-    event = get_object_or_404(Event.objects.all(), pk=pk)
-    more_events = Event.objects.current().exclude(pk=event.pk)[:3]
+    event = get_object_or_404(Event.objects.with_summaries()
+                                           .prefetch_related(*EVENT_DETAIL_PREFETCHES), pk=pk)
+    more_events = list(Event.objects.current().exclude(pk=event.pk).with_summaries()[:3])
+    prefetch_first_destinations(more_events)
     context = dict(tab='explore', event=event, more_events=more_events,
                    **DEFAULT_CONTEXT)
     return base_view(request, 'event-detail.html', context=context)
 
 
 def tour_detail(request, pk):
-    tour = get_object_or_404(Tour.objects.all(), pk=pk)
-    more_tours = Tour.objects.published().exclude(pk=tour.pk)[:3]
+    tour = get_object_or_404(Tour.objects.with_summaries()
+                                         .prefetch_related(*TOUR_DETAIL_PREFETCHES), pk=pk)
+    # cards show the first destination's image
+    more_tours = list(Tour.objects.published().exclude(pk=tour.pk).shuffled()
+                      .with_summaries()[:3])
+    prefetch_first_destinations(more_tours)
     context = dict(tab='explore', tour=tour, more_tours=more_tours,
                    **DEFAULT_CONTEXT)
     return base_view(request, 'tour-detail.html', context=context)
 
 
-def image_to_url(obj, field_name, size, raw_field_name=''):
-    """Helper for converting an image object property to a url for a json response.
-
-    :param obj: Model object with {image} and {image}_raw fields
-    :param field_name: String identifier for the image field
-    :returns: URL of the image, or an empty string if there is no image
-    """
-    if not raw_field_name:
-        raw_field_name = field_name + '_raw'
-    options = {
-        'size': size,
-        'crop': True,
-        'detail': True
-    }
-    box = getattr(obj, field_name)
-    if box:
-        options['box'] = box
-
-    try:
-        return get_backend().get_thumbnail_url(getattr(obj, raw_field_name), options)
-    except InvalidImageFormatError:
-        return ''
-
-
-def set_location_properties(obj, location):
-    """Helper to set location-related properties on either destinations or events.
-
-    Events have optional related destination, which is the event location.
-
-    :param obj: Dictionary representation of object to which to add location properties
-    :param location: Destination object from which to extract location properties
-    :returns: passed obj dictionary, with added properties
-    """
-    obj['placeID'] = location.pk if location else None
-    obj['point'] = json.loads(location.point.json) if location else None
-    obj['attributes'] = {
-        'City': location.city if location else None,
-        'Postal': location.zipcode if location else None,
-        'Region': location.state if location else None,
-        'StAddr': location.address if location else None
-    }
-    # convert to format like properties on ESRI geocoder results
-    x = obj['point']['coordinates'][0] if location else None
-    y = obj['point']['coordinates'][1] if location else None
-    obj['extent'] = {'xmax': x, 'xmin': x, 'ymax': y, 'ymin': y}
-    obj['location'] = {'x': x, 'y': y}
-    return obj
-
-
-def set_attraction_properties(obj, model, extra_images):
-    """Helper to set serialized properties common to destinations and events.
-
-    :param obj: Dictionary representation of object
-    :param model: Django model object with the expected properties of an Attraction
-    :param extra_images: Filtered queryset of `ExtraImage` related objects to the Attraction
-    :returns: Dictionary representation of object, with added properties
-    """
-    obj['image'] = image_to_url(model, 'image', NARROW_IMAGE_DIMENSIONS)
-    obj['wide_image'] = image_to_url(model, 'wide_image', WIDE_IMAGE_DIMENSIONS)
-    del obj['image_raw']
-    del obj['wide_image_raw']
-
-    # return URLs for extra images, in both narrow and wide formats
-    extras_list = []
-    wide_extras_list = []
-    for extra in extra_images:
-        extras_list.append(image_to_url(extra, 'image', NARROW_IMAGE_DIMENSIONS))
-        wide_extras_list.append(image_to_url(extra,
-                                             'wide_image',
-                                             WIDE_IMAGE_DIMENSIONS,
-                                             'image_raw'))
-    obj['extra_images'] = extras_list
-    obj['extra_wide_images'] = wide_extras_list
-
-    obj['activities'] = [a.name for a in obj['activities']]
-    # add convenience property for whether destination has cycling
-    obj['cycling'] = model.has_activity('cycling')
-
-    return obj
-
-
-def set_destination_properties(destination):
-    """Helper for adding and converting properties in serializing destinations as JSON.
-
-    :param destination: Destination model object
-    :returns: Dictionary representation of object, with added properties
-    """
-    obj = model_to_dict(destination)
-    obj['address'] = obj['name']
-    obj['categories'] = [c.name for c in obj['categories']]
-    obj['is_event'] = False
-    obj['is_tour'] = False
-
-    # Add truncated information on related tours (just ID and name)
-    related_tours = list(Tour.objects.filter(published=True,
-                         tour_destinations__destination=destination).values('id', 'name'))
-
-    obj['related_tours'] = related_tours
-    extra_images = ExtraDestinationPicture.objects.filter(destination=destination)
-    obj = set_attraction_properties(obj, destination, extra_images)
-    obj = set_location_properties(obj, destination)
-    return obj
-
-
-def set_event_properties(event):
-    """Helper for adding and converting properties in serializing events as JSON.
+class FindReachableDestinations(View):
+    """Class based view for fetching isochrone and finding destinations of interest within it.
 
-    :param event: Event model object
-    :returns: Dictionary representation of object, with added properties
-    """
-    obj = model_to_dict(event)
-    obj['address'] = event.name
-
-    obj['categories'] = (EVENT_CATEGORY,)  # events are a special category
-    obj['start_date'] = timezone.localtime(event.start_date).isoformat()
-    obj['end_date'] = timezone.localtime(event.end_date).isoformat()
-    obj['is_event'] = True
-    obj['is_tour'] = False
-
-    extra_images = ExtraEventPicture.objects.filter(event=event)
-    obj = set_attraction_properties(obj, event, extra_images)
-    # add properties of first related destination, if any
-    obj = set_location_properties(obj, event.first_destination)
-    destinations = []
-    for x in event.event_destinations.all():
-        dest = set_destination_properties(x.destination)
-        dest['order'] = x.order
-        # optional start/end date/times
-        dest['start_date'] = timezone.localtime(x.start_date).isoformat() if x.start_date else ''
-        dest['end_date'] = timezone.localtime(x.end_date).isoformat() if x.end_date else ''
-        destinations.append(dest)
-    obj['destinations'] = destinations
-
-    # For backwards compatibility for the mobile app,
-    # still return 'destination' with the ID of the first destination, if any.
-    obj['destination'] = destinations[0]['id'] if len(destinations) > 0 else None
-
-    # if the first related destination belongs to Watershed Alliance, so does this event
-    obj['watershed_alliance'] = (event.event_destinations.first().destination.watershed_alliance
-                                 if event.event_destinations.count() else False)
-    return obj
-
-
-def set_tour_properties(tour):
-    """Helper for adding and converting properties in serializing tours as JSON.
-
-    :param tour: Tour model object
-    :returns: Dictionary representation of object, with added properties
+    This view is async, so that a worker is not tied up while waiting on OTP.
     """
-    obj = model_to_dict(tour)
-    obj['categories'] = (TOUR_CATEGORY,)  # tours are a special category
-    # tour location is that of its first destination
-    obj = set_location_properties(obj, tour.first_destination)
-    obj['is_tour'] = True
-    obj['is_event'] = False
-
-    obj['destinations'] = []
-    for x in tour.tour_destinations.all():
-        dest = set_destination_properties(x.destination)
-        dest['order'] = x.order
-        obj['destinations'].append(dest)
-
-    # Use the images from the first destination for the tour
-    if tour.tour_destinations.count() > 0:
-        first_dest = obj['destinations'][0]
-        obj['image'] = first_dest['image']
-        obj['wide_image'] = first_dest['wide_image']
-
-    return obj
-
-
-class FindReachableDestinations(View):
-    """Class based view for fetching isochrone and finding destinations of interest within it."""
 
     otp_router = 'default'
     isochrone_url = settings.ISOCHRONE_URL
     algorithm = 'accSampling'
 
-    def isochrone(self, payload):
+    async def isochrone(self, payload):
+        """Get isochrone geometry for the provided args.
+
+        The origin and departure time are snapped to the isochrone cache grid, and the result is
+        served from the cache if a matching isochrone has already been fetched.
+        Identical concurrent requests, in this worker or others, share a single request to OTP.
+        """
+        payload = snap_isochrone_params(payload)
+        cache_key = await sync_to_async(isochrone_cache_key)(payload)
+        json_poly = await sync_to_async(get_cached_isochrone)(cache_key)
+        if json_poly is not None:
+            return json_poly
+
+        # Waiting on another worker's request only spares OTP the duplicate load; the isochrone
+        # cache is per-worker, so a waiter that can't load the result there fetches it itself.
+        return await isochrone_flights.do(cache_key,
+                                          partial(self.fetch_and_cache_isochrone, payload,
+                                                  cache_key),
+                                          load=partial(sync_to_async(get_cached_isochrone),
+                                                       cache_key))
+
+    async def fetch_and_cache_isochrone(self, payload, cache_key):
+        """Fetch the isochrone from OTP, and cache it before any waiting requests are released."""
+        json_poly = await self.fetch_isochrone(payload)
+        # only cache actual travelsheds, so a transient OTP failure isn't served repeatedly
+        if 'features' in json_poly:
+            await sync_to_async(cache_isochrone)(cache_key, json_poly)
+        return json_poly
+
+    async def fetch_isochrone(self, payload):
         """Make request to Open Trip Planner for isochrone geometry.
 
         Take the provided args and return OTP JSON.
         """
+        payload = payload.copy()
         payload['routerId'] = self.otp_router
         payload['algorithm'] = self.algorithm
         headers = {'Accept': 'application/json'}
 
         # Need to set accept header for isochrone endpoint, or else it will occasionally decide to
         # return a shapefile, although it's supposed to default to geojson.
-        isochrone_response = requests.get(self.isochrone_url, params=payload, headers=headers)
+        # Raises OTPUnavailableError if OTP can't be reached.
+        isochrone_response = await get_otp_client().aget(self.isochrone_url,
+                                                         params=dict(payload.lists()),
+                                                         headers=headers)
 
         # Parse and traverse JSON from OTP so that we return only geometries
         try:
@@ -364,55 +273,127 @@ class FindReachableDestinations(View):
             json_poly = json.loads("{}")
         return json_poly
 
-    def get(self, request, *args, **kwargs):
+    def match_destinations(self, index, json_poly, cutoffs, from_place, categories):
+        """Find explorable destinations within the isochrone, using the in-memory index.
+
+        The features of each travel time band are combined, so each band is matched in one pass.
+
+        :param index: TravelshedIndex of explorable destinations
+        :param json_poly: Isochrone GeoJSON FeatureCollection from OTP
+        :param cutoffs: Sorted list of requested travel time cutoffs, in seconds
+        :param from_place: Origin as a 'lat,lon' string, used to order results by distance
+        :param categories: Optional comma-separated category names to filter to
+        :returns: List of (destination ID, smallest cutoff reaching it) tuples,
+                  ordered by distance from the origin then priority
+        """
+        # Have a FeatureCollection of MultiPolygons
+        bands = isochrone_bands(json_poly, cutoffs)
+        if not bands:
+            return []
+
+        try:
+            lat, lon = [float(coord) for coord in from_place.split(',')]
+            origin = Point(lon, lat, srid=4326)
+        except (AttributeError, ValueError):
+            origin = None
+        categories = categories.split(',') if categories else None
+
+        # Bands are nested, so match each of the inner ones to find where destinations first appear,
+        # then the outermost for the full, ordered list
+        band_cutoffs = {}
+        for cutoff, travelshed in bands[:-1]:
+            for pk in index.match(travelshed, categories=categories):
+                band_cutoffs.setdefault(pk, cutoff)
+        outer_cutoff, outer_travelshed = bands[-1]
+        return [(pk, band_cutoffs.get(pk, outer_cutoff))
+                for pk in index.match(outer_travelshed, origin, categories)]
+
+    def serialize_matched(self, destinations):
+        """Get matched destinations' JSON documents; runs in a thread, as it may make queries."""
+        return destination_documents(destinations)
+
+    async def get(self, request, *args, **kwargs):
         """When a GET hits this endpoint, calculate an isochrone and find destinations within it.
 
         Return both the isochrone GeoJSON and the list of matched destinations.
+        Multiple travel times may be sent as repeated (or comma-separated) `cutoffSec` params,
+        in which case the isochrone has a nested band per travel time. Each matched destination has
+        a `cutoffSec` property with the smallest travel time that reaches it.
         Can send optional comma-separated `categories` param to filter by destination category.
+        The isochrone is simplified for display at the map zoom level given by the optional `zoom`
+        param (or estimated from `cutoffSec`), and its rings can be returned as encoded polylines
+        by sending `encoding=polyline`.
         """
         params = request.GET.copy()  # make mutable
 
+        try:
+            cutoffs = parse_cutoffs(params)
+        except ValueError as e:
+            return return_400('Invalid cutoffSec, must be an integer', str(e))
         # allow a max travelshed size of 60 minutes in a query
-        cutoff_sec = int(params.get('cutoffSec', -1))
-        if not cutoff_sec or cutoff_sec < 0 or cutoff_sec > 3600:
+        if not cutoffs or cutoffs[0] <= 0 or cutoffs[-1] > 3600:
             return return_400('cutoffSec out of range',
                               'cutoffSec must be greater than 0 and less than 360')
+        params.setlist('cutoffSec', [str(cutoff) for cutoff in cutoffs])
 
-        json_poly = self.isochrone(params)
-
-        # Have a FeatureCollection of MultiPolygons
-        if 'features' in json_poly:
-            matched_objects = []
-            for poly in json_poly['features']:
-                geom_str = json.dumps(poly['geometry'])
-                geom = GEOSGeometry(geom_str, srid=4326)
-                # include destinations that are published
-                # or are in a published tour or event
-                matched_objects = (Destination.objects.filter(
-                    Q(point__within=geom) &
-                    (Q(published=True) |
-                        (Q(tours__isnull=False) & Q(tours__related_tour__published=True)) |
-                        (Q(events__isnull=False) & Q(events__related_event__published=True))))
-                    .distinct()
-                    .annotate(distance=Distance('point', geom))
-                    .order_by('distance', 'priority'))
-        else:
-            matched_objects = []
-
-        categories = params.get('categories', None)
-        if categories:
-            matched_objects = matched_objects.filter(categories__name__in=categories.split(','))
-
-        # make locations JSON serializable
-        matched_objects = [set_destination_properties(x) for x in matched_objects]
+        encoding = params.get('encoding', None)
+        if encoding and encoding not in ISOCHRONE_ENCODINGS:
+            return return_400('Invalid encoding',
+                              'encoding must be one of: ' + ', '.join(ISOCHRONE_ENCODINGS))
+        try:
+            zoom = parse_zoom(params['zoom']) if params.get('zoom') else None
+        except ValueError as e:
+            return return_400('Invalid zoom, must be an integer from 0 to 22', str(e))
 
-        response = {'matched': matched_objects, 'isochrone': json_poly}
-        return JsonResponse(response)
+        try:
+            json_poly = await self.isochrone(params)
+        except OTPUnavailableError as e:
+            return return_503('Trip planner unavailable', str(e))
+
+        index = await sync_to_async(get_travelshed_index)()
+        matched = self.match_destinations(index, json_poly, cutoffs, params.get('fromPlace'),
+                                          params.get('categories', None))
+        destinations = await Destination.objects.ain_bulk([pk for pk, _ in matched])
+        matched = [(destinations[pk], cutoff) for pk, cutoff in matched if pk in destinations]
+
+        matched_documents = await sync_to_async(self.serialize_matched)(
+            [destination for destination, _ in matched])
+        matched_documents = [add_properties(document, {'cutoffSec': cutoff})
+                             for document, (_, cutoff) in zip(matched_documents, matched)]
+
+        # match against the full isochrone, but return a lighter one for display
+        json_poly = simplify_isochrone(json_poly,
+                                       isochrone_simplify_tolerance(cutoffs[-1], zoom),
+                                       encoding)
+
+        response = encode_object([('matched', matched_documents), ('isochrone', json_poly)])
+        return HttpResponse(response, content_type='application/json')
+
+
+MVT_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+
+# Default and maximum number of autocomplete suggestions
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# Orderings of search results; each ends with a unique field, so results can be paged through
+# with keyset pagination
+DESTINATION_ORDERING = ('priority', 'id')
+DESTINATION_DISTANCE_ORDERING = ('knn_distance', 'priority', 'id')
+EVENT_ORDERING = ('priority', 'start_date', 'id')
+TOUR_ORDERING = ('priority', 'id')
+
+# Sets of properties returned for each search result by each view; None for all of them
+SEARCH_VIEWS = {
+    'full': None,
+    'summary': SUMMARY_FIELDS,
+}
 
 
 class SearchDestinations(View):
     """View for searching destinations via an http endpoint."""
 
+    @method_decorator(condition(etag_func=content_etag))
     def get(self, request, *args, **kwargs):
         """Get destinations that match search queries.
 
@@ -421,71 +402,247 @@ class SearchDestinations(View):
           - text param
         Optional:
           - limit param: maximum number of results to return (integer)
+          - cursor param: to page through results, send an empty cursor for the first page, then
+            the `next` cursor from each response to get the following page (`next` is null on the
+            last page). Pages are of `limit` results of each type, or a default page size.
           - categories param: comma-separated list of category names to filter to
-
-        A search via text returns destinations, events, and tours that match the name
-        A search via lat/lon returns destinations, events, and tours that are
-        closest to the search point
-
+          - view param: `full` (the default) to return all properties of each result, or
+            `summary` to return only its ID, name, type, and point
+          - fields param: comma-separated list of the properties to return for each result,
+            instead of those of the `view` (properties of nested destinations are not filtered)
+
+        A search via text returns destinations, events, and tours with names containing or
+        similar to the text, or with names or descriptions (or for destinations, categories)
+        matching it, best matches first
+        A search via lat/lon returns the destinations closest to the search point, each with its
+        `distance` from it in meters, along with events and tours. Nearest destinations are
+        found with the spatial index, so are always limited (to `limit`, or a default limit).
+
+        Destinations, events, and tours are found in one query, and their serialized documents
+        come from the cache when unchanged.
         """
         params = request.GET
         lat = params.get('lat', None)
         lon = params.get('lon', None)
         text = params.get('text', None)
+        # a blank search text matches everything
+        search_text = text.strip() if text else ''
         limit = params.get('limit', None)
         categories = params.get('categories', None)
 
+        view = params.get('view', 'full')
+        if view not in SEARCH_VIEWS:
+            return return_400('Invalid view', 'view must be one of: ' + ', '.join(SEARCH_VIEWS))
+        fields = params.get('fields', None)
+        if fields:
+            fields = frozenset(field for field in fields.split(',') if field)
+        else:
+            fields = SEARCH_VIEWS[view]
+
         destinations = Destination.objects.none()
         events = Event.objects.none()
         tours = Tour.objects.none()
 
+        destination_ordering = DESTINATION_ORDERING
+        search_point = None
         if lat and lon:
             try:
                 search_point = Point(float(lon), float(lat), srid=4326)
             except ValueError as e:
                 return return_400('Invalid latitude/longitude pair', str(e))
+            # distance in meters, which orders by the spatial index
             destinations = (Destination.objects.filter(published=True)
-                            .annotate(distance=Distance('point', search_point))
-                            .order_by('distance', 'priority'))
+                            .annotate(knn_distance=nearest_distance(search_point)))
+            destination_ordering = DESTINATION_DISTANCE_ORDERING
         elif text is not None:
-            destinations = Destination.objects.filter(published=True,
-                                                      name__icontains=text).order_by('priority')
+            destinations = Destination.objects.filter(published=True)
+            if search_text:
+                destinations = destination_text_search(destinations, search_text)
+                destination_ordering = SEARCH_ORDERING
 
         # get events and filter both events and destinations by category
         if categories:
             categories = categories.split(',')
             if EVENT_CATEGORY in categories:
                 categories.remove(EVENT_CATEGORY)
-                events = (Event.objects.current()
-                          .order_by('priority', 'start_date'))
+                events = Event.objects.current()
             if TOUR_CATEGORY in categories:
                 categories.remove(TOUR_CATEGORY)
-                tours = (Tour.objects.filter(published=True).order_by('priority'))
+                tours = Tour.objects.filter(published=True)
             destinations = destinations.filter(categories__name__in=categories)
         else:
-            events = (Event.objects.current()
-                      .order_by('priority', 'start_date'))
-            tours = (Tour.objects.filter(published=True).order_by('priority'))
+            events = Event.objects.current()
+            tours = Tour.objects.filter(published=True)
+
+        event_ordering, tour_ordering = EVENT_ORDERING, TOUR_ORDERING
+        if search_text:
+            events = text_search(events, search_text)
+            tours = text_search(tours, search_text)
+            event_ordering = tour_ordering = SEARCH_ORDERING
 
-        if text is not None:
-            events = events.filter(name__icontains=text)
-            tours = tours.filter(name__icontains=text)
+        destinations = destinations.order_by(*destination_ordering)
+        events = events.order_by(*event_ordering)
+        tours = tours.order_by(*tour_ordering)
 
+        limit_int = None
         if limit:
             try:
                 limit_int = int(limit)
             except ValueError as e:
                 return return_400('Invalid limit, must be an integer', str(e))
-            destinations = destinations[:limit_int]
-            events = events[:limit_int]
-            tours = tours[:limit_int]
 
-        destinations = [set_destination_properties(x) for x in destinations]
-        events = [set_event_properties(x) for x in events]
-        tours = [set_tour_properties(x) for x in tours]
+        distance = None
+        if search_point and (fields is None or 'distance' in fields):
+            # the distance in the index ordering is in meters
+            distance = F('knn_distance')
+
+        # select the same columns from each search, so that the IDs of the results of all three
+        # can be found in one query
+        orderings = {'destinations': destination_ordering,
+                     'events': event_ordering,
+                     'tours': tour_ordering}
+        searches = {'destinations': search_rows(destinations, 'destinations',
+                                                destination_ordering, distance),
+                    'events': search_rows(events, 'events', event_ordering),
+                    'tours': search_rows(tours, 'tours', tour_ordering)}
+        if 'cursor' in params:
+            page_size = max(1, min(limit_int or settings.SEARCH_PAGE_SIZE,
+                                   settings.SEARCH_MAX_PAGE_SIZE))
+            try:
+                positions = decode_cursor(params['cursor'])
+                searches = {kind: page_queryset(queryset, orderings[kind],
+                                                positions.get(kind, []), page_size)
+                            for kind, queryset in searches.items()}
+            except InvalidCursorError as e:
+                return return_400('Invalid cursor', str(e))
+        else:
+            destinations_limit = limit_int
+            if search_point:
+                # nearest neighbor searches must be limited to use the spatial index
+                destinations_limit = min(limit_int or settings.SEARCH_NEAREST_LIMIT,
+                                         settings.SEARCH_NEAREST_LIMIT)
+            if destinations_limit is not None:
+                searches['destinations'] = searches['destinations'][:destinations_limit]
+            if limit_int is not None:
+                searches['events'] = searches['events'][:limit_int]
+                searches['tours'] = searches['tours'][:limit_int]
+
+        # then documents of the results are taken from the cache, and only those not cached are
+        # loaded and serialized
+        rows = union_search(orderings, **searches)
+
+        next_positions = {}
+        if 'cursor' in params:
+            for kind, ordering in orderings.items():
+                rows[kind], next_positions[kind] = split_page(
+                    rows[kind], page_size,
+                    lambda row, ordering=ordering: [row[ORDERING_COLUMNS[field]]
+                                                    for field in ordering])
+
+        destination_docs = destination_documents_by_id([row[1] for row in rows['destinations']],
+                                                       fields)
+        if distance is not None:
+            destination_docs = [
+                add_properties(document, {'distance': round(row[5], 1)}) if document else None
+                for document, row in zip(destination_docs, rows['destinations'])]
+        event_docs = event_documents_by_id([row[1] for row in rows['events']], fields)
+        tour_docs = tour_documents_by_id([row[1] for row in rows['tours']], fields)
+
+        # leave out any results deleted since they were found
+        members = [('destinations', [document for document in destination_docs if document]),
+                   ('events', [document for document in event_docs if document]),
+                   ('tours', [document for document in tour_docs if document])]
+        if 'cursor' in params:
+            members.append(('next', encode_cursor(next_positions)))
+        return HttpResponse(encode_object(members), content_type='application/json')
+
+
+class AutocompleteDestinations(View):
+    """View for suggesting destinations, events, and tours as search text is typed."""
+
+    def get(self, request, *args, **kwargs):
+        """Get published destinations, current events, and published tours with a word in their
+        name starting with the `text` param.
+
+        Optional:
+          - limit param: maximum number of suggestions to return (integer)
 
-        response = {'destinations': destinations, 'events': events, 'tours': tours}
-        return JsonResponse(response)
+        Suggestions have only an ID, type (destination, event, or tour), name, and point, and
+        come from an in-memory index rather than the database.
+        """
+        text = request.GET.get('text', '')
+        try:
+            limit = int(request.GET.get('limit', AUTOCOMPLETE_LIMIT))
+        except ValueError as e:
+            return return_400('Invalid limit, must be an integer', str(e))
+        limit = max(0, min(limit, AUTOCOMPLETE_MAX_LIMIT))
+
+        suggestions = get_autocomplete_index().suggest(text, limit)
+        return JsonResponse({'suggestions': [suggestion.as_dict() for suggestion in suggestions]})
+
+
+class ViewportDestinations(View):
+    """View for showing destinations on the map, within the area it displays."""
+
+    @method_decorator(condition(etag_func=content_etag))
+    def get(self, request, *args, **kwargs):
+        """Get published destinations within a bounding box.
+
+        Must pass:
+          - bbox param: comma-separated min longitude, min latitude, max longitude, max latitude
+          - zoom param: web map zoom level (integer from 0 to 22)
+        Optional:
+          - categories param: comma-separated list of category names to filter to
+
+        At zoom levels below `CLUSTER_MAX_ZOOM`, returns `clusters` of the destinations on a grid,
+        each with its `count` of destinations and the `point` at their center (and the `id` of
+        the destination, for clusters of one). Otherwise returns up to `SEARCH_MAX_PAGE_SIZE`
+        `destinations` in order of priority, with the properties of the summary search view, and
+        sets `truncated` if there are more in the bounding box.
+        """
+        params = request.GET
+        try:
+            bbox = parse_bbox(params.get('bbox', ''))
+        except ValueError as e:
+            return return_400('Invalid bbox', str(e))
+        try:
+            zoom = parse_zoom(params.get('zoom', ''))
+        except ValueError as e:
+            return return_400('Invalid zoom, must be an integer from 0 to 22', str(e))
+
+        destinations = Destination.objects.published().filter(point__contained=bbox)
+        categories = params.get('categories', None)
+        if categories:
+            destinations = destinations.filter(categories__name__in=categories.split(','))
+
+        if zoom < settings.CLUSTER_MAX_ZOOM:
+            members = [('destinations', []),
+                       ('clusters', cluster_destinations(destinations, zoom)),
+                       ('truncated', False)]
+        else:
+            max_destinations = settings.SEARCH_MAX_PAGE_SIZE
+            pks = list(destinations.distinct().order_by('priority', 'id')
+                       .values_list('pk', flat=True)[:max_destinations + 1])
+            documents = destination_documents_by_id(pks[:max_destinations], SUMMARY_FIELDS)
+            members = [('destinations', [document for document in documents if document]),
+                       ('clusters', []),
+                       ('truncated', len(pks) > max_destinations)]
+        return HttpResponse(encode_object(members), content_type='application/json')
+
+
+@condition(etag_func=content_etag)
+def destination_tile(request, z, x, y):
+    """Mapbox vector tile of published destinations, current events, and published tours.
+
+    Features are in a single `destinations` layer, with `id`, `name`, `type` (destination,
+    event, or tour), and `categories` (comma-separated names, for destinations) properties.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if not valid_tile(z, x, y):
+        return return_400('Invalid tile', 'No tile {z}/{x}/{y}'.format(z=z, x=x, y=y))
+    response = HttpResponse(get_tile(z, x, y), content_type=MVT_CONTENT_TYPE)
+    patch_cache_control(response, public=True, max_age=settings.TILE_MAX_AGE)
+    return response
 
 
 def return_400(message, error):
@@ -497,6 +654,15 @@ def return_400(message, error):
     return JsonResponse(error, status=400)
 
 
+def return_503(message, error):
+    # Helper to return JSON error messages for unavailable upstream services
+    error = {
+        'msg': message,
+        'error': error
+    }
+    return JsonResponse(error, status=503)
+
+
 class UserFlagView(View):
     """POST-only endpoint for recording anonymous user flags on destinations from mobile app.
 